@@ -113,10 +113,10 @@ AUTH_PASSWORD_VALIDATORS = [
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
-        'rest_framework_api_key.permissions.HasAPIKey',
+        'weather_app.permissions.HasAPIKey',
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'weather_app.authentication.CachedJWTAuthentication',
     ),
 }
 
@@ -147,14 +147,105 @@ AUTH_USER_MODEL = 'weather_app.User'
 
 API_KEY_CUSTOM_HEADER = "HTTP_API_SECRET_KEY"
 HTTP_API_SECRET_KEY = config('my_service_api_key')
+# verified API keys are remembered per process, revoking or deleting a key drops them everywhere
+API_KEY_CACHE_TTL = config('API_KEY_CACHE_TTL', default=60, cast=int)
+API_KEY_CACHE_MAX_SIZE = config('API_KEY_CACHE_MAX_SIZE', default=1024, cast=int)
+# users resolved from access tokens are cached by token id, changes to the user or subscription drop them
+AUTH_CACHE_TTL = config('AUTH_CACHE_TTL', default=60, cast=int)
+# subscription reads are cached per user until the next write through the API
+RESPONSE_CACHE_TTL = config('RESPONSE_CACHE_TTL', default=24 * 60 * 60, cast=int)
 
 OPEN_WEATHER_API_URL = 'http://api.openweathermap.org/data/2.5/weather'
+OPEN_WEATHER_GROUP_API_URL = 'http://api.openweathermap.org/data/2.5/group'
+OPEN_WEATHER_GROUP_LIMIT = 20
+OPEN_WEATHER_CONNECT_TIMEOUT = config('OPEN_WEATHER_CONNECT_TIMEOUT', default=3.05, cast=float)
+OPEN_WEATHER_READ_TIMEOUT = config('OPEN_WEATHER_READ_TIMEOUT', default=10.0, cast=float)
+OPEN_WEATHER_RETRIES = config('OPEN_WEATHER_RETRIES', default=3, cast=int)
+OPEN_WEATHER_BACKOFF_FACTOR = config('OPEN_WEATHER_BACKOFF_FACTOR', default=0.5, cast=float)
+OPEN_WEATHER_POOL_SIZE = config('OPEN_WEATHER_POOL_SIZE', default=20, cast=int)
+OPEN_WEATHER_CALLS_PER_MINUTE = config('OPEN_WEATHER_CALLS_PER_MINUTE', default=60, cast=int)
+OPEN_WEATHER_CALLS_PER_DAY = config('OPEN_WEATHER_CALLS_PER_DAY', default=32000, cast=int)
+OPEN_WEATHER_BURST = config('OPEN_WEATHER_BURST', default=10, cast=int)
+OPEN_WEATHER_RATE_LIMIT_MAX_WAIT = config('OPEN_WEATHER_RATE_LIMIT_MAX_WAIT', default=2.0, cast=float)
+OPEN_WEATHER_BREAKER_THRESHOLD = config('OPEN_WEATHER_BREAKER_THRESHOLD', default=5, cast=int)
+OPEN_WEATHER_BREAKER_RESET_TIMEOUT = config('OPEN_WEATHER_BREAKER_RESET_TIMEOUT', default=30.0, cast=float)
+
+# cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': config('CACHE_URL', default='redis://redis:6379/1'),
+    },
+}
+WEATHER_CACHE_TTL = config('WEATHER_CACHE_TTL', default=600, cast=int)
+WEATHER_CACHE_STALE_TTL = config('WEATHER_CACHE_STALE_TTL', default=6 * 60 * 60, cast=int)
+WEATHER_REFRESH_LOCK_TTL = config('WEATHER_REFRESH_LOCK_TTL', default=30, cast=int)
+WEATHER_CACHE_MAX_SIZE = config('WEATHER_CACHE_MAX_SIZE', default=1024, cast=int)
+WEATHER_FETCH_WORKERS = config('WEATHER_FETCH_WORKERS', default=16, cast=int)
+WEATHER_REQUEST_DEADLINE = config('WEATHER_REQUEST_DEADLINE', default=5.0, cast=float)
+# streamed /api/get_weather/ responses look up this many cities at a time
+WEATHER_STREAM_CHUNK_SIZE = config('WEATHER_STREAM_CHUNK_SIZE', default=100, cast=int)
+
+# city catalog
+CITY_CATALOG_PATH = config('CITY_CATALOG_PATH', default=str(BASE_DIR / 'data' / 'city_catalog.tsv'))
+CITY_LIST_URL = 'http://bulk.openweathermap.org/sample/city.list.json.gz'
+CITY_LOOKUP_CACHE_TTL = config('CITY_LOOKUP_CACHE_TTL', default=24 * 60 * 60, cast=int)
+
+# email
+SENDGRID_API_HOST = config('SENDGRID_API_HOST', default='https://api.sendgrid.com')
+SENDGRID_PERSONALIZATIONS_LIMIT = 1000
+# seconds per SendGrid request, has to stay well below OUTBOX_LEASE
+SENDGRID_TIMEOUT = config('SENDGRID_TIMEOUT', default=30, cast=float)
 
 # celery
 CELERY_BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_ROUTES = {
+    'dispatch_due_notifications_task': {'queue': 'dispatch'},
+    'warm_weather_cache_task': {'queue': 'dispatch'},
+    'warm_cities_task': {'queue': 'fetch'},
+    'fetch_weather_task': {'queue': 'fetch'},
+    'render_notifications_task': {'queue': 'render'},
+    'drain_outbox_task': {'queue': 'send'},
+    'sweep_outbox_task': {'queue': 'dispatch'},
+    'send_email_task': {'queue': 'send'},
+}
+CELERY_WORKER_PREFETCH_MULTIPLIER = config('CELERY_WORKER_PREFETCH_MULTIPLIER', default=1, cast=int)
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    'dispatch-due-notifications': {
+        'task': 'dispatch_due_notifications_task',
+        'schedule': config('NOTIFICATIONS_DISPATCH_INTERVAL', default=60, cast=int),
+    },
+    'warm-weather-cache': {
+        'task': 'warm_weather_cache_task',
+        'schedule': config('WEATHER_WARMING_INTERVAL', default=60, cast=int),
+    },
+    'sweep-outbox': {
+        'task': 'sweep_outbox_task',
+        'schedule': config('OUTBOX_SWEEP_INTERVAL', default=60, cast=int),
+    },
+}
+
+NOTIFICATIONS_DISPATCH_BATCH_SIZE = config('NOTIFICATIONS_DISPATCH_BATCH_SIZE', default=500, cast=int)
+
+# rendered notifications wait in the outbox until a sender worker delivers them
+OUTBOX_BATCH_SIZE = config('OUTBOX_BATCH_SIZE', default=500, cast=int)
+# seconds a claimed batch is hidden from other senders, after that it is sent again
+OUTBOX_LEASE = config('OUTBOX_LEASE', default=300, cast=int)
+OUTBOX_MAX_ATTEMPTS = config('OUTBOX_MAX_ATTEMPTS', default=5, cast=int)
+# first retry delay in seconds, doubled after every failed attempt
+OUTBOX_RETRY_DELAY = config('OUTBOX_RETRY_DELAY', default=60, cast=int)
+# sent and failed messages are kept this many seconds
+OUTBOX_RETENTION = config('OUTBOX_RETENTION', default=7 * 24 * 60 * 60, cast=int)
+
+# cities of subscriptions due within the lead time are fetched ahead, so it has to stay below WEATHER_CACHE_TTL
+WEATHER_WARMING_LEAD_TIME = config('WEATHER_WARMING_LEAD_TIME', default=300, cast=int)
+WEATHER_WARMING_INTERVAL = CELERY_BEAT_SCHEDULE['warm-weather-cache']['schedule']
+WEATHER_WARMING_QUOTA_SHARE = config('WEATHER_WARMING_QUOTA_SHARE', default=0.5, cast=float)
 
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
@@ -1,7 +1,100 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Q
+from django.utils.functional import cached_property
 
-from weather_app.models import User, Subscription, CityInSubscription
+from weather_app.cache import normalize_city
+from weather_app.models import User, Subscription, City, CityInSubscription, OutboxMessage
 
-admin.site.register(User)
-admin.site.register(Subscription)
-admin.site.register(CityInSubscription)
+
+def estimate_count(model):
+    if connection.vendor != 'postgresql':
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [model._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+class EstimatedCountPaginator(Paginator):
+    """Uses the planner's row estimate instead of COUNT(*) for unfiltered lists of large tables."""
+
+    exact_count_limit = 10000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = estimate_count(self.object_list.model)
+            if estimate > self.exact_count_limit:
+                return estimate
+        return super().count
+
+
+class IndexedAdmin(admin.ModelAdmin):
+    """
+    Changelist for large tables: newest rows first by primary key, estimated
+    counts, and search by exact values of indexed columns only.
+    """
+
+    ordering = ('-id',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    indexed_search_fields = ()
+
+    def get_search_fields(self, request):
+        return self.indexed_search_fields
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        condition = Q(pk=int(search_term)) if search_term.isdigit() and len(search_term) < 10 else Q()
+        for field in self.indexed_search_fields:
+            condition |= Q(**{field: self.search_value(field, search_term)})
+        return queryset.filter(condition), False
+
+    def search_value(self, field, search_term):
+        return search_term
+
+
+@admin.register(User)
+class UserAdmin(IndexedAdmin):
+    list_display = ('email', 'is_staff', 'is_active', 'date_joined')
+    indexed_search_fields = ('email',)
+
+
+@admin.register(Subscription)
+class SubscriptionAdmin(IndexedAdmin):
+    list_display = ('id', 'user', 'period_notifications', 'next_due_at', 'date_of_subscription')
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    indexed_search_fields = ('user__email',)
+
+
+@admin.register(City)
+class CityAdmin(IndexedAdmin):
+    list_display = ('name', 'owm_id', 'normalized_name')
+    indexed_search_fields = ('normalized_name',)
+
+    def search_value(self, field, search_term):
+        return normalize_city(search_term)
+
+
+@admin.register(CityInSubscription)
+class CityInSubscriptionAdmin(IndexedAdmin):
+    list_display = ('name', 'city', 'subscription')
+    list_select_related = ('city', 'subscription__user')
+    raw_id_fields = ('subscription', 'city')
+    indexed_search_fields = ('city__normalized_name', 'subscription__user__email')
+
+    def search_value(self, field, search_term):
+        return normalize_city(search_term) if field == 'city__normalized_name' else search_term
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(IndexedAdmin):
+    list_display = ('idempotency_key', 'email', 'status', 'attempts', 'available_at', 'sent_at')
+    raw_id_fields = ('subscription',)
+    indexed_search_fields = ('idempotency_key',)
@@ -0,0 +1,92 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from weather_app.client import ASYNC_TRANSPORT_ERRORS, weather_api_get_async
+from weather_app.catalog import CityLookupUnavailable, city_id_from, known_city_id, remember_city_id
+from weather_app.models import CityInSubscription, add_city, get_subscription_for_city, subscription_filter
+from weather_app.serializers import CityInSubscriptionSerializer
+from weather_app.tasks import get_weather_concurrently_async
+
+
+async def find_city_id_async(city_name):
+    city_id = await sync_to_async(known_city_id, thread_sensitive=False)(city_name)
+    if city_id is None:
+        try:
+            r = await weather_api_get_async(settings.OPEN_WEATHER_API_URL, q=city_name)
+        except ASYNC_TRANSPORT_ERRORS as e:
+            raise CityLookupUnavailable() from e
+        city_id = city_id_from(r)
+        await sync_to_async(remember_city_id, thread_sensitive=False)(city_name, city_id)
+    return city_id or None
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView whose handlers are coroutines. Authentication and permission checks
+    run in a worker thread, so the ORM is never touched from the event loop.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        async def view(request, *args, **kwargs):
+            self = cls(**initkwargs)
+            return await self.dispatch_async(request, *args, **kwargs)
+
+        view.cls = cls
+        view.initkwargs = initkwargs
+        view.csrf_exempt = True
+        return view
+
+    async def dispatch_async(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            handler = self.get_async_handler(request)
+            response = await handler(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        return self.finalize_response(request, response, *args, **kwargs)
+
+    def get_async_handler(self, request):
+        method = request.method.lower()
+        handler = getattr(self, method, None) if method in self.http_method_names else None
+        if handler is None:
+            self.http_method_not_allowed(request)
+        if not asyncio.iscoroutinefunction(handler):
+            handler = sync_to_async(handler)
+        return handler
+
+
+class AsyncGetWeatherView(AsyncAPIView):
+
+    async def get(self, request):
+        cities = CityInSubscription.objects.filter(subscription_filter(request.user))
+        city_names = await sync_to_async(list)(cities.values_list('name', flat=True))
+        response_get_weather = await get_weather_concurrently_async(city_names, settings.WEATHER_REQUEST_DEADLINE)
+        return Response(response_get_weather)
+
+
+class AsyncMyCitiesCreateView(AsyncAPIView):
+
+    async def post(self, request):
+        input_city = request.data['name']
+        subscription = await sync_to_async(get_subscription_for_city)(request.user.id, input_city)
+        if subscription.has_city:
+            return Response("City already added in your subscription")
+        city_id = await find_city_id_async(input_city)
+        if city_id is None:
+            return Response("City doesn't exist")
+        new_city = await sync_to_async(add_city)(subscription, input_city, city_id)
+        if new_city is None:
+            return Response("City already added in your subscription")
+        serializer = CityInSubscriptionSerializer(new_city)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
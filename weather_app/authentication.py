@@ -0,0 +1,33 @@
+import time
+
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+from weather_app.cache import token_users
+from weather_app.models import Subscription
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that keeps the resolved user and the id of their
+    subscription in the cache by token id, so repeated requests with the
+    same token do not load them from the database.
+    """
+
+    def get_user(self, validated_token):
+        token_id = validated_token.get(api_settings.JTI_CLAIM)
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if token_id is None or user_id is None:
+            return super().get_user(validated_token)
+        entry, version = token_users.get(token_id, user_id)
+        if entry is None:
+            entry = self.resolve(validated_token)
+            token_users.set(token_id, version, lifetime=validated_token['exp'] - time.time(), **entry)
+        user = entry['user']
+        user.subscription_id = entry['subscription_id']
+        return user
+
+    def resolve(self, validated_token):
+        user = super().get_user(validated_token)
+        subscription_id = Subscription.objects.filter(user=user).values_list('id', flat=True).first()
+        return {'user': user, 'subscription_id': subscription_id}
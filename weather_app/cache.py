@@ -0,0 +1,335 @@
+import hashlib
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import caches
+
+STATS_KEYS = ('local_hits', 'shared_hits', 'stale_hits', 'misses')
+
+
+def normalize_city(city_name):
+    return ' '.join(city_name.split()).lower()
+
+
+class LRUCache:
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SingleFlight:
+    """
+    Collapses concurrent work on the same keys: the first caller to claim a
+    key does the work, later callers wait for its result.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def claim(self, keys):
+        owned, pending = {}, {}
+        with self._lock:
+            for key in keys:
+                if key in self._calls:
+                    pending[key] = self._calls[key]
+                else:
+                    owned[key] = self._calls[key] = Future()
+        return owned, pending
+
+    def release(self, owned, results, error=None):
+        with self._lock:
+            for key in owned:
+                del self._calls[key]
+        for key, future in owned.items():
+            if key in results:
+                future.set_result(results[key])
+            else:
+                future.set_exception(error or LookupError(key))
+
+    def do(self, key, fn):
+        owned, pending = self.claim([key])
+        if pending:
+            return pending[key].result()
+        try:
+            result = fn()
+        except Exception as e:
+            self.release(owned, {}, e)
+            raise
+        self.release(owned, {key: result})
+        return result
+
+
+class WeatherCache:
+    """
+    Two-tier cache for weather readings keyed by normalized city name:
+    a per-process LRU in front of the shared Django cache (Redis).
+    Readings are fresh for ``ttl`` seconds and kept for ``stale_ttl`` more,
+    so the last known reading can be served while the provider is down.
+    """
+
+    key_prefix = 'weather'
+    stats_flush_every = 100
+
+    def __init__(self, ttl=None, max_size=None, alias='default', stale_ttl=None):
+        self.ttl = settings.WEATHER_CACHE_TTL if ttl is None else ttl
+        self.stale_ttl = settings.WEATHER_CACHE_STALE_TTL if stale_ttl is None else stale_ttl
+        self.local = LRUCache(settings.WEATHER_CACHE_MAX_SIZE if max_size is None else max_size)
+        self.alias = alias
+        self._counters = dict.fromkeys(STATS_KEYS, 0)
+        self._unflushed = dict.fromkeys(STATS_KEYS, 0)
+        self._lock = Lock()
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def make_key(self, city_name):
+        return f'{self.key_prefix}:{normalize_city(city_name)}'
+
+    def get_entry(self, city_name):
+        key = self.make_key(city_name)
+        entry = self.local.get(key)
+        if entry is not None and self.is_fresh(entry):
+            self._count('local_hits')
+            return entry
+        shared_entry = self.shared.get(key)
+        if shared_entry is not None and (entry is None or shared_entry['fetched_at'] > entry['fetched_at']):
+            self.local.set(key, shared_entry)
+            entry = shared_entry
+        self._count(self._lookup_result(entry))
+        return entry
+
+    def fresh_until(self, city_name):
+        entry = self.shared.get(self.make_key(city_name))
+        return entry['fetched_at'] + self.ttl if entry is not None else None
+
+    def set(self, city_name, data):
+        key = self.make_key(city_name)
+        entry = {'data': data, 'fetched_at': time.time()}
+        self.local.set(key, entry)
+        self.shared.set(key, entry, timeout=self.ttl + self.stale_ttl)
+
+    def reading(self, entry):
+        if self.is_fresh(entry):
+            return entry['data']
+        return dict(entry['data'], stale=True, age=int(time.time() - entry['fetched_at']))
+
+    def claim_refresh(self, city_name):
+        return self.shared.add(f'{self.make_key(city_name)}:refresh', 1, timeout=settings.WEATHER_REFRESH_LOCK_TTL)
+
+    def delete(self, city_name):
+        key = self.make_key(city_name)
+        self.local.delete(key)
+        self.shared.delete(key)
+
+    def stats(self):
+        with self._lock:
+            process = dict(self._counters)
+        self.flush_stats()
+        cluster = {name: self.shared.get(self._stats_key(name), 0) for name in STATS_KEYS}
+        return {
+            'ttl': self.ttl,
+            'local_size': len(self.local),
+            'local_max_size': self.local.max_size,
+            'process': dict(process, hit_ratio=self._hit_ratio(process)),
+            'cluster': dict(cluster, hit_ratio=self._hit_ratio(cluster)),
+        }
+
+    def flush_stats(self):
+        with self._lock:
+            unflushed, self._unflushed = self._unflushed, dict.fromkeys(STATS_KEYS, 0)
+        for name, value in unflushed.items():
+            if value:
+                key = self._stats_key(name)
+                self.shared.add(key, 0, timeout=None)
+                self.shared.incr(key, value)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+            self._unflushed[name] += 1
+            pending = sum(self._unflushed.values())
+        if pending >= self.stats_flush_every:
+            self.flush_stats()
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    def _lookup_result(self, entry):
+        if entry is None:
+            return 'misses'
+        return 'shared_hits' if self.is_fresh(entry) else 'stale_hits'
+
+    def _stats_key(self, name):
+        return f'{self.key_prefix}:stats:{name}'
+
+    @staticmethod
+    def _hit_ratio(counters):
+        hits = counters['local_hits'] + counters['shared_hits']
+        total = hits + counters['stale_hits'] + counters['misses']
+        return round(hits / total, 4) if total else None
+
+
+class VerifiedKeyCache:
+    """
+    Per-process memory of API keys that passed the (slow) password hasher,
+    keyed by a SHA-256 digest of the key. An entry lives at most ``ttl``
+    seconds and only while the shared generation it was stored under is
+    current; ``invalidate`` replaces the generation, dropping the entries in
+    every process.
+    """
+
+    generation_key = 'api_keys:generation'
+
+    def __init__(self, ttl=None, max_size=None, alias='default'):
+        self.ttl = settings.API_KEY_CACHE_TTL if ttl is None else ttl
+        self.local = LRUCache(settings.API_KEY_CACHE_MAX_SIZE if max_size is None else max_size)
+        self.alias = alias
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def digest(self, key):
+        return hashlib.sha256(key.encode()).digest()
+
+    def generation(self):
+        return self.shared.get(self.generation_key)
+
+    def is_verified(self, key, generation):
+        entry = self.local.get(self.digest(key))
+        return entry is not None and entry[0] == generation and entry[1] > time.monotonic()
+
+    def add(self, key, generation, lifetime=None):
+        ttl = self.ttl if lifetime is None else min(self.ttl, lifetime)
+        self.local.set(self.digest(key), (generation, time.monotonic() + ttl))
+
+    def invalidate(self):
+        self.local.clear()
+        self.shared.set(self.generation_key, uuid.uuid4().hex, timeout=None)
+
+
+class TokenUserCache:
+    """
+    Users resolved from access tokens, with their subscription id, kept in
+    the shared cache by token id. Each user has a version that ``invalidate``
+    replaces when the account or subscription changes, which retires the
+    entries of all their tokens.
+    """
+
+    key_prefix = 'auth'
+
+    def __init__(self, ttl=None, alias='default'):
+        self.ttl = settings.AUTH_CACHE_TTL if ttl is None else ttl
+        self.alias = alias
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def token_key(self, token_id):
+        return f'{self.key_prefix}:token:{token_id}'
+
+    def version_key(self, user_id):
+        return f'{self.key_prefix}:version:{user_id}'
+
+    def get(self, token_id, user_id):
+        token_key, version_key = self.token_key(token_id), self.version_key(user_id)
+        found = self.shared.get_many([token_key, version_key])
+        entry, version = found.get(token_key), found.get(version_key)
+        if entry is not None and entry['version'] == version:
+            return entry, version
+        return None, version
+
+    def set(self, token_id, version, user, subscription_id, lifetime):
+        entry = {'version': version, 'user': user, 'subscription_id': subscription_id}
+        self.shared.set(self.token_key(token_id), entry, timeout=max(1, min(self.ttl, lifetime)))
+
+    def invalidate(self, user_id):
+        # outlives every entry stored under the previous version
+        self.shared.set(self.version_key(user_id), uuid.uuid4().hex, timeout=self.ttl)
+
+
+class ResponseCache:
+    """
+    Serialized API responses per user, kept in the shared cache. Every user
+    has a version that is part of the keys of their responses and serves as
+    their ETag, its time as their Last-Modified. Write paths ``bump`` it, so
+    a stored response is never served after the data behind it changed.
+    """
+
+    key_prefix = 'responses'
+
+    def __init__(self, ttl=None, alias='default'):
+        self.ttl = settings.RESPONSE_CACHE_TTL if ttl is None else ttl
+        self.alias = alias
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def version_key(self, user_id):
+        return f'{self.key_prefix}:version:{user_id}'
+
+    def response_key(self, user_id, version, path):
+        digest = hashlib.sha256(path.encode()).hexdigest()
+        return f'{self.key_prefix}:{user_id}:{version["tag"]}:{digest}'
+
+    def new_version(self):
+        return {'tag': uuid.uuid4().hex, 'modified': int(time.time())}
+
+    def version(self, user_id):
+        key = self.version_key(user_id)
+        version = self.shared.get(key)
+        if version is None:
+            version = self.new_version()
+            if not self.shared.add(key, version, timeout=self.ttl):
+                version = self.shared.get(key) or version
+        return version
+
+    def bump(self, user_id):
+        self.shared.set(self.version_key(user_id), self.new_version(), timeout=self.ttl)
+
+    def get(self, user_id, version, path):
+        return self.shared.get(self.response_key(user_id, version, path))
+
+    def set(self, user_id, version, path, data):
+        self.shared.set(self.response_key(user_id, version, path), data, timeout=self.ttl)
+
+
+weather_cache = WeatherCache()
+response_cache = ResponseCache()
+verified_keys = VerifiedKeyCache()
+token_users = TokenUserCache()
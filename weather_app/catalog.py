@@ -0,0 +1,177 @@
+import gzip
+import json
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.exceptions import APIException
+
+from weather_app.cache import normalize_city
+from weather_app.client import WeatherApiError, weather_api_get
+
+CatalogCity = namedtuple('CatalogCity', ('id', 'name', 'country'))
+
+
+class CityLookupUnavailable(WeatherApiError, APIException):
+    status_code = 503
+    default_detail = 'City validation is unavailable, try again later.'
+
+
+class CityCatalog:
+    """
+    Read-only index of the provider's city list, kept as parallel arrays sorted
+    by normalized name and loaded from CITY_CATALOG_PATH on first use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._keys = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        self.load()
+        return len(self._keys)
+
+    def load(self):
+        if self._keys is not None:
+            return
+        with self._lock:
+            if self._keys is None:
+                self._read()
+
+    def reload(self):
+        with self._lock:
+            self._read()
+
+    def lookup(self, city_name):
+        """Returns the city with that name, or None when the name is missing or several cities share it."""
+        self.load()
+        key = normalize_city(city_name)
+        index = bisect_left(self._keys, key)
+        # the provider ranks cities that share a name in a way the list cannot reproduce
+        if bisect_right(self._keys, key, index) - index == 1:
+            return self._entry(index)
+        return None
+
+    def search(self, prefix, limit):
+        self.load()
+        key = normalize_city(prefix)
+        if not key:
+            return []
+        start = bisect_left(self._keys, key)
+        end = bisect_left(self._keys, key + '\uffff', start, min(start + limit, len(self._keys)))
+        return [self._entry(index) for index in range(start, end)]
+
+    def _entry(self, index):
+        return CatalogCity(self._ids[index], self._names[index], self._countries[index])
+
+    def _read(self):
+        keys, ids, names, countries = [], array('L'), [], []
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    key, owm_id, name, country = line.rstrip('\n').split('\t')
+                    keys.append(key)
+                    ids.append(int(owm_id))
+                    names.append(name)
+                    countries.append(country)
+        self._ids, self._names, self._countries = ids, names, countries
+        self._keys = keys
+
+
+def read_city_list(data):
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    return json.loads(data)
+
+
+def write_catalog(cities, path):
+    rows = sorted(
+        (normalize_city(city['name']), city['id'], ' '.join(city['name'].split()), city.get('country', ''))
+        for city in cities
+        if city['name'].strip()
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write('\t'.join(map(str, row)) + '\n')
+    return len(rows)
+
+
+def city_id_key(city_name):
+    return f'city_id:{normalize_city(city_name)}'
+
+
+def known_city_id(city_name):
+    entry = city_catalog.lookup(city_name)
+    if entry is not None:
+        return entry.id
+    return cache.get(city_id_key(city_name))
+
+
+def known_city_ids(city_names):
+    city_ids = {}
+    for city_name in city_names:
+        entry = city_catalog.lookup(city_name)
+        if entry is not None:
+            city_ids[city_name] = entry.id
+    cached = cache.get_many([city_id_key(city_name) for city_name in city_names if city_name not in city_ids])
+    for city_name in city_names:
+        city_ids.setdefault(city_name, cached.get(city_id_key(city_name)))
+    return city_ids
+
+
+def remember_city_id(city_name, city_id):
+    cache.set(city_id_key(city_name), city_id or 0, timeout=settings.CITY_LOOKUP_CACHE_TTL)
+
+
+def city_id_from(response):
+    # only a 404 says the city does not exist, any other answer must not be remembered as one
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise CityLookupUnavailable()
+    return response.json()['id']
+
+
+def fetch_city_id(city_name):
+    try:
+        r = weather_api_get(settings.OPEN_WEATHER_API_URL, q=city_name)
+    except requests.RequestException as e:
+        raise CityLookupUnavailable() from e
+    return city_id_from(r)
+
+
+def fetch_city_ids(city_names):
+    with ThreadPoolExecutor(max_workers=min(len(city_names), settings.WEATHER_FETCH_WORKERS)) as executor:
+        city_ids = dict(zip(city_names, executor.map(fetch_city_id, city_names)))
+    cache.set_many(
+        {city_id_key(city_name): city_id or 0 for city_name, city_id in city_ids.items()},
+        timeout=settings.CITY_LOOKUP_CACHE_TTL,
+    )
+    return city_ids
+
+
+def find_city_id(city_name):
+    city_id = known_city_id(city_name)
+    if city_id is None:
+        city_id = fetch_city_id(city_name)
+        remember_city_id(city_name, city_id)
+    return city_id or None
+
+
+def find_city_ids(city_names):
+    city_ids = known_city_ids(city_names)
+    unknown = [city_name for city_name, city_id in city_ids.items() if city_id is None]
+    if unknown:
+        city_ids.update(fetch_city_ids(unknown))
+    return {city_name: city_id or None for city_name, city_id in city_ids.items()}
+
+
+city_catalog = CityCatalog(settings.CITY_CATALOG_PATH)
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+
+import anyio
+import httpx
+import requests
+from decouple import config
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from rest_framework.exceptions import APIException
+
+from weather_app.ratelimit import upstream_limiter
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+# what a pooled httpx client raises besides httpx.HTTPError, e.g. when it was closed under a request
+ASYNC_TRANSPORT_ERRORS = (httpx.HTTPError, anyio.ClosedResourceError, anyio.BrokenResourceError, RuntimeError)
+
+
+class WeatherApiError(Exception):
+    pass
+
+
+class CircuitOpen(WeatherApiError, APIException):
+    status_code = 503
+    default_detail = 'Weather provider is unavailable, try again later.'
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast for ``reset_timeout`` seconds after ``failure_threshold``
+    upstream failures in a row. After that one probe call is let through and
+    its outcome closes the breaker or keeps it open.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpen()
+            self.opened_at = time.monotonic()
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                self.failures, self.opened_at = 0, None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker(settings.OPEN_WEATHER_BREAKER_THRESHOLD, settings.OPEN_WEATHER_BREAKER_RESET_TIMEOUT)
+
+
+def get_timeout():
+    return settings.OPEN_WEATHER_CONNECT_TIMEOUT, settings.OPEN_WEATHER_READ_TIMEOUT
+
+
+def create_session():
+    adapter = HTTPAdapter(
+        pool_connections=settings.OPEN_WEATHER_POOL_SIZE,
+        pool_maxsize=settings.OPEN_WEATHER_POOL_SIZE,
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session, _session_pid = create_session(), os.getpid()
+        return _session
+
+
+def create_async_client():
+    connect, read = get_timeout()
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(read, connect=connect),
+        limits=httpx.Limits(
+            max_connections=settings.OPEN_WEATHER_POOL_SIZE,
+            max_keepalive_connections=settings.OPEN_WEATHER_POOL_SIZE,
+        ),
+    )
+
+
+def get_async_client():
+    """One pooled client per event loop, so connections are kept alive across requests."""
+    loop = asyncio.get_event_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = _async_clients[loop] = create_async_client()
+    return client
+
+
+async def close_async_client():
+    client = _async_clients.pop(asyncio.get_event_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def check_response(response):
+    if response.status_code != 200:
+        raise WeatherApiError(f'OpenWeather answered {response.status_code}')
+    return response
+
+
+def weather_api_get(url, **params):
+    params['appid'] = config('weather_api_key')
+    breaker.before_call()
+    try:
+        response = send(get_session(), url, params)
+    except requests.RequestException:
+        breaker.record(success=False)
+        raise
+    breaker.record(success=response.status_code < 500)
+    return response
+
+
+async def weather_api_get_async(url, **params):
+    params['appid'] = config('weather_api_key')
+    breaker.before_call()
+    try:
+        response = await send_async(get_async_client(), url, params)
+    except ASYNC_TRANSPORT_ERRORS:
+        breaker.record(success=False)
+        raise
+    breaker.record(success=response.status_code < 500)
+    return response
+
+
+def send(session, url, params):
+    for attempt in range(settings.OPEN_WEATHER_RETRIES):
+        upstream_limiter.acquire()
+        response = session.get(url, params=params, timeout=get_timeout())
+        if response.status_code not in RETRY_STATUSES:
+            return response
+        time.sleep(settings.OPEN_WEATHER_BACKOFF_FACTOR * 2 ** attempt)
+    upstream_limiter.acquire()
+    return session.get(url, params=params, timeout=get_timeout())
+
+
+async def send_async(client, url, params):
+    for attempt in range(settings.OPEN_WEATHER_RETRIES):
+        await upstream_limiter.acquire_async()
+        response = await client.get(url, params=params)
+        if response.status_code not in RETRY_STATUSES:
+            return response
+        await asyncio.sleep(settings.OPEN_WEATHER_BACKOFF_FACTOR * 2 ** attempt)
+    await upstream_limiter.acquire_async()
+    return await client.get(url, params=params)
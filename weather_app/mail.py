@@ -0,0 +1,119 @@
+import json
+import logging
+from collections import namedtuple
+from http.client import HTTPException
+
+from decouple import config
+from django.conf import settings
+from django.template.loader import get_template
+from python_http_client.exceptions import HTTPError
+from sendgrid import SendGridAPIClient
+from sendgrid.helpers.mail import Mail, Personalization, To
+
+from weather_app.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+Notification = namedtuple('Notification', ('email', 'html_content'))
+
+_client = None
+_client_host = None
+_fragment_template = None
+
+fragment_cache = LRUCache(settings.WEATHER_CACHE_MAX_SIZE)
+
+
+def get_sendgrid_client():
+    global _client, _client_host
+    if _client is None or _client_host != settings.SENDGRID_API_HOST:
+        _client = SendGridAPIClient(config('sendgrid_api_key'), host=settings.SENDGRID_API_HOST)
+        _client.client.timeout = settings.SENDGRID_TIMEOUT
+        _client_host = settings.SENDGRID_API_HOST
+    return _client
+
+
+def get_fragment_template():
+    global _fragment_template
+    if _fragment_template is None:
+        _fragment_template = get_template('emails/city_weather.html')
+    return _fragment_template
+
+
+def fragment_context(weather):
+    return {'weather': {name.replace(' ', '_'): value for name, value in weather.items()}}
+
+
+def fragment_key(weather):
+    # a stale reading shows its age in whole minutes, the seconds would make every render a miss
+    minutes = round(weather['age'] / 60) if 'age' in weather else None
+    return tuple((name, value) for name, value in weather.items() if name != 'age'), minutes
+
+
+def render_fragment(weather):
+    key = fragment_key(weather)
+    fragment = fragment_cache.get(key)
+    if fragment is None:
+        fragment = get_fragment_template().render(fragment_context(weather))
+        fragment_cache.set(key, fragment)
+    return fragment
+
+
+def render_fragments(weather_by_city):
+    return {key: render_fragment(weather) for key, weather in weather_by_city.items()}
+
+
+def render_notification(cities, fragments):
+    return ''.join([fragments.get(city.normalized_name, '') for city in cities])
+
+
+def build_message(html_content, emails):
+    message = Mail(
+        from_email=config('from_email'),
+        subject='Weather notification',
+        html_content=html_content
+    )
+    for email in emails:
+        personalization = Personalization()
+        personalization.add_to(To(email))
+        message.add_personalization(personalization)
+    return message
+
+
+def group_by_content(notifications):
+    groups = {}
+    for notification in notifications:
+        groups.setdefault(notification.html_content, []).append(notification)
+    return groups
+
+
+def names_recipients(body):
+    """Whether a SendGrid error body blames personalizations, rather than the message as a whole."""
+    try:
+        errors = json.loads(body).get('errors') or []
+    except (TypeError, ValueError, AttributeError):
+        return False
+    return any(str(error.get('field') or '').startswith('personalizations') for error in errors)
+
+
+def send_batch(html_content, notifications):
+    try:
+        get_sendgrid_client().send(build_message(html_content, [notification.email for notification in notifications]))
+    except HTTPError as e:
+        # only a recipient error is worth narrowing down, any other 400 would fail every half the same way
+        if e.status_code == 400 and len(notifications) > 1 and names_recipients(e.body):
+            middle = len(notifications) // 2
+            return send_batch(html_content, notifications[:middle]) + send_batch(html_content, notifications[middle:])
+        logger.warning('SendGrid rejected %d recipients: %s %s', len(notifications), e.status_code, e.body)
+        return [(notification, e.status_code) for notification in notifications]
+    except (OSError, HTTPException) as e:
+        logger.warning('SendGrid is unreachable: %s', e)
+        return [(notification, None) for notification in notifications]
+    return []
+
+
+def content_batches(notifications):
+    """Yields (html_content, notifications) of one request each, up to SENDGRID_PERSONALIZATIONS_LIMIT recipients."""
+    limit = settings.SENDGRID_PERSONALIZATIONS_LIMIT
+    for html_content, group in group_by_content(notifications).items():
+        for i in range(0, len(group), limit):
+            yield html_content, group[i:i + limit]
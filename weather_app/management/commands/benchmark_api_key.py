@@ -0,0 +1,44 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework_api_key.models import APIKey
+
+from weather_app.cache import verified_keys
+from weather_app.models import CachedAPIKey
+
+
+def cpu_per_check(is_valid, key, checks):
+    started = time.process_time()
+    for _ in range(checks):
+        if not is_valid(key):
+            raise AssertionError('Benchmark key was rejected')
+    return (time.process_time() - started) / checks * 1e6
+
+
+class Command(BaseCommand):
+    help = 'Measure CPU time per request spent checking the API key, with and without the verified-key cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checks', type=int, default=50)
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+    def handle(self, *args, **options):
+        api_key, key = APIKey.objects.create_key(name='benchmark')
+        try:
+            verified_keys.local.clear()
+            CachedAPIKey.objects.is_valid(key)
+            result = {
+                'checks': options['checks'],
+                'uncached_us_per_check': cpu_per_check(APIKey.objects.is_valid, key, options['checks']),
+                'cached_us_per_check': cpu_per_check(CachedAPIKey.objects.is_valid, key, options['checks']),
+            }
+        finally:
+            api_key.delete()
+        if options['json']:
+            self.stdout.write(json.dumps(result, indent=2))
+            return
+        self.stdout.write(
+            f"uncached {result['uncached_us_per_check']:.2f} us, "
+            f"cached {result['cached_us_per_check']:.2f} us CPU per check"
+        )
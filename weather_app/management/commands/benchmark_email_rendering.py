@@ -0,0 +1,107 @@
+import json
+import random
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from weather_app.mail import fragment_cache, fragment_context, get_fragment_template, render_fragment
+from weather_app.tasks import rendered_bodies
+
+
+def render_concatenated(cities, weather_by_city):
+    html_content = ''
+    for city in cities:
+        weather = weather_by_city[city.normalized_name]
+        html_content += f'''<p>
+                                <strong>{weather["city"]}</strong><br>
+                                Temperature {weather["temperature"]}<br>
+                                Feels like {weather["feels like"]}<br>
+                                {weather["description"]}<br>
+                                Wind speed {weather["wind speed"]}<br>
+                            </p>'''
+    return html_content
+
+
+def render_uncached(cities, weather_by_city):
+    template = get_fragment_template()
+    return ''.join(template.render(fragment_context(weather_by_city[city.normalized_name])) for city in cities)
+
+
+def make_subscription(i, cities):
+    cities_in_subscription = [SimpleNamespace(city=city) for city in cities]
+    return SimpleNamespace(
+        user=SimpleNamespace(email=f'user_{i}@example.com'),
+        cities=SimpleNamespace(all=lambda: cities_in_subscription),
+    )
+
+
+def make_window(recipients, city_count, rng):
+    cities = [SimpleNamespace(name=f'City {i}', normalized_name=f'city {i}') for i in range(city_count)]
+    weather_by_city = {
+        city.normalized_name: {
+            'city': city.name,
+            'temperature': f'{rng.uniform(-20, 35):.2f}°C',
+            'feels like': f'{rng.uniform(-25, 35):.2f}°C',
+            'description': rng.choice(['clear sky', 'few clouds', 'light rain', 'snow']),
+            'wind speed': f'{rng.uniform(0, 15):.2f} m/s',
+        }
+        for city in cities
+    }
+    subscriptions = [make_subscription(i, rng.sample(cities, rng.randint(1, 5))) for i in range(recipients)]
+    return subscriptions, weather_by_city
+
+
+def per_email(render, subscriptions, weather_by_city):
+    started = time.perf_counter()
+    for subscription in subscriptions:
+        render([city_in_subscription.city for city_in_subscription in subscription.cities.all()], weather_by_city)
+    return (time.perf_counter() - started) / len(subscriptions) * 1e6
+
+
+def per_email_cached(subscriptions, weather_by_city, cold):
+    """The rendering write_outbox does for a window, without the insert. Cold includes rendering every fragment."""
+    if cold:
+        fragment_cache.clear()
+    started = time.perf_counter()
+    for _ in rendered_bodies(subscriptions, weather_by_city):
+        pass
+    return (time.perf_counter() - started) / len(subscriptions) * 1e6
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure email rendering cost per recipient for one delivery window. '
+        'The concatenated baseline does not escape the weather data, the template paths do.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, nargs='+', default=[10000, 100000])
+        parser.add_argument('--cities', type=int, default=200, help='Distinct cities in the window')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        render_fragment({'city': 'warm-up'})
+        results = []
+        for recipients in options['recipients']:
+            subscriptions, weather_by_city = make_window(recipients, options['cities'], rng)
+            results.append({
+                'recipients': recipients,
+                'concatenated_us_per_email': per_email(render_concatenated, subscriptions, weather_by_city),
+                'template_us_per_email': per_email(render_uncached, subscriptions, weather_by_city),
+                'cached_fragments_cold_us_per_email': per_email_cached(subscriptions, weather_by_city, cold=True),
+                'cached_fragments_warm_us_per_email': per_email_cached(subscriptions, weather_by_city, cold=False),
+            })
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for result in results:
+            self.stdout.write(
+                f"{result['recipients']:>8} recipients: "
+                f"concatenated {result['concatenated_us_per_email']:.2f} us, "
+                f"template {result['template_us_per_email']:.2f} us, "
+                f"cached fragments {result['cached_fragments_cold_us_per_email']:.2f} us cold, "
+                f"{result['cached_fragments_warm_us_per_email']:.2f} us warm per email"
+            )
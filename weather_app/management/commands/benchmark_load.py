@@ -0,0 +1,218 @@
+import json
+import random
+import statistics
+import threading
+import time
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+from rest_framework_api_key.models import APIKey
+from rest_framework_simplejwt.tokens import AccessToken
+
+from weather_app import client
+from weather_app.cache import weather_cache
+from weather_app.client import CircuitBreaker
+from weather_app.models import City, CityInSubscription, Subscription, User
+from weather_app.ratelimit import UpstreamLimiter
+from weather_app.stubs import openweather_stub, sendgrid_stub
+from weather_app.tasks import send_notifications
+
+EMAIL_DOMAIN = 'benchmark.invalid'
+FIRST_CITY_ID = 900000000
+ENDPOINTS = ('/api/get_weather/', '/api/subscription/')
+REPORTED_OPTIONS = (
+    'subscriptions', 'cities_per_subscription', 'city_pool', 'openweather_latency', 'openweather_error_rate',
+    'sendgrid_latency', 'sendgrid_error_rate', 'requests', 'concurrency', 'seed',
+)
+
+
+def create_fixtures(options, rng):
+    City.objects.bulk_create([
+        City(name=f'Benchmark city {i}', normalized_name=f'benchmark city {i}', owm_id=FIRST_CITY_ID + i)
+        for i in range(options['city_pool'])
+    ])
+    User.objects.bulk_create([
+        User(email=f'user_{i}@{EMAIL_DOMAIN}', password='!') for i in range(options['subscriptions'])
+    ])
+    cities = list(City.objects.filter(owm_id__gte=FIRST_CITY_ID))
+    users = list(User.objects.filter(email__endswith=f'@{EMAIL_DOMAIN}'))
+    Subscription.objects.bulk_create([
+        Subscription(user=user, period_notifications=rng.choice(Subscription.Period.values)) for user in users
+    ])
+    subscriptions = list(Subscription.objects.filter(user__in=users))
+    CityInSubscription.objects.bulk_create([
+        CityInSubscription(subscription=subscription, city=city, name=city.name)
+        for subscription in subscriptions
+        for city in rng.sample(cities, min(options['cities_per_subscription'], len(cities)))
+    ])
+    return users, [subscription.id for subscription in subscriptions]
+
+
+def delete_fixtures():
+    User.objects.filter(email__endswith=f'@{EMAIL_DOMAIN}').delete()
+    for city in City.objects.filter(owm_id__gte=FIRST_CITY_ID):
+        weather_cache.delete(city.name)
+    City.objects.filter(owm_id__gte=FIRST_CITY_ID).delete()
+
+
+def benchmark_dispatch(sub_ids, batch_size, openweather, sendgrid):
+    started = time.perf_counter()
+    failed = 0
+    for i in range(0, len(sub_ids), batch_size):
+        failed += len(send_notifications(Subscription.objects.filter(id__in=sub_ids[i:i + batch_size])))
+    elapsed = time.perf_counter() - started
+    sent = sum(len(body['personalizations']) for body in sendgrid.requests) - failed
+    return {
+        'subscriptions': len(sub_ids),
+        'elapsed_s': round(elapsed, 3),
+        'emails_sent': sent,
+        'emails_failed': failed,
+        'emails_per_s': round(sent / elapsed, 2) if elapsed else None,
+        'upstream_calls': len(openweather.requests),
+        'upstream_calls_per_email': round(len(openweather.requests) / sent, 4) if sent else None,
+        'sendgrid_requests': len(sendgrid.requests),
+    }
+
+
+def run_requests(url, credentials, count, results):
+    api = APIClient()
+    try:
+        for i in range(count):
+            api.credentials(**credentials[i % len(credentials)])
+            started = time.perf_counter()
+            response = api.get(url)
+            results.append((time.perf_counter() - started, response.status_code))
+    finally:
+        connection.close()
+
+
+def benchmark_endpoint(url, credentials, total, concurrency):
+    results = []
+    threads = [
+        threading.Thread(target=run_requests, args=(url, credentials, total // concurrency, results))
+        for _ in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(results, time.perf_counter() - started)
+
+
+def summarize(results, elapsed):
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    if not latencies:
+        return {'requests': 0}
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': len(latencies),
+        'errors': sum(1 for _, status_code in results if status_code >= 400),
+        'requests_per_s': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(percentiles[49], 2),
+        'p90_ms': round(percentiles[89], 2),
+        'p99_ms': round(percentiles[98], 2),
+        'max_ms': round(latencies[-1], 2),
+    }
+
+
+def api_credentials(users, key):
+    return [
+        {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(user)}', 'HTTP_API_SECRET_KEY': key}
+        for user in users
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Measure notification dispatch throughput and API latency against local OpenWeather and SendGrid stubs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscriptions', type=int, default=1000)
+        parser.add_argument('--cities-per-subscription', type=int, default=3)
+        parser.add_argument('--city-pool', type=int, default=200, help='Distinct cities shared by all subscriptions')
+        parser.add_argument('--openweather-latency', type=float, default=0.05, help='Seconds added to every answer')
+        parser.add_argument('--openweather-error-rate', type=float, default=0.0)
+        parser.add_argument('--sendgrid-latency', type=float, default=0.1)
+        parser.add_argument('--sendgrid-error-rate', type=float, default=0.0)
+        parser.add_argument('--requests', type=int, default=500, help='Requests per endpoint, 0 to skip')
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        openweather = openweather_stub(
+            latency=options['openweather_latency'], error_rate=options['openweather_error_rate'],
+        )
+        sendgrid = sendgrid_stub(latency=options['sendgrid_latency'], error_rate=options['sendgrid_error_rate'])
+        with ExitStack() as stack:
+            for context in self.stub_contexts(openweather, sendgrid):
+                stack.enter_context(context)
+            report = self.run(options, openweather, sendgrid)
+        self.write_report(report, options['output'])
+
+    def stub_contexts(self, openweather, sendgrid):
+        return [
+            openweather,
+            sendgrid,
+            override_settings(
+                OPEN_WEATHER_API_URL=f'{openweather.url}/data/2.5/weather',
+                OPEN_WEATHER_GROUP_API_URL=f'{openweather.url}/data/2.5/group',
+                SENDGRID_API_HOST=sendgrid.url,
+                OPEN_WEATHER_CALLS_PER_MINUTE=10 ** 9,
+                OPEN_WEATHER_BURST=10 ** 6,
+            ),
+            patch.object(client, 'upstream_limiter', UpstreamLimiter(key_prefix='benchmark:upstream')),
+            patch.object(client, 'breaker', CircuitBreaker(
+                settings.OPEN_WEATHER_BREAKER_THRESHOLD, settings.OPEN_WEATHER_BREAKER_RESET_TIMEOUT,
+            )),
+        ]
+
+    def run(self, options, openweather, sendgrid):
+        delete_fixtures()
+        try:
+            users, sub_ids = create_fixtures(options, random.Random(options['seed']))
+            report = {
+                'started_at': datetime.now(timezone.utc).isoformat(),
+                'options': {name: options[name] for name in REPORTED_OPTIONS},
+                'dispatch': benchmark_dispatch(
+                    sub_ids, settings.NOTIFICATIONS_DISPATCH_BATCH_SIZE, openweather, sendgrid,
+                ),
+                'api': {},
+            }
+            if options['requests']:
+                report['api'] = self.benchmark_api(users, options)
+        finally:
+            delete_fixtures()
+        return report
+
+    def benchmark_api(self, users, options):
+        api_key, key = APIKey.objects.create_key(name='benchmark')
+        try:
+            credentials = api_credentials(users, key)
+            return {
+                url: benchmark_endpoint(url, credentials, options['requests'], options['concurrency'])
+                for url in ENDPOINTS
+            }
+        finally:
+            api_key.delete()
+
+    def write_report(self, report, output):
+        data = json.dumps(report, indent=2)
+        if output is None:
+            self.stdout.write(data)
+            return
+        with open(output, 'w') as f:
+            f.write(data)
+        dispatch = report['dispatch']
+        self.stdout.write(
+            f"dispatch: {dispatch['emails_per_s']} emails/s, "
+            f"{dispatch['upstream_calls_per_email']} upstream calls per email"
+        )
+        for url, result in report['api'].items():
+            self.stdout.write(f"{url}: p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms")
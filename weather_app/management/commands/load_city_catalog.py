@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from weather_app.catalog import city_catalog, read_city_list, write_catalog
+from weather_app.client import get_session
+
+
+class Command(BaseCommand):
+    help = 'Import the OpenWeatherMap bulk city list into the local city catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', nargs='?', default=settings.CITY_LIST_URL,
+                            help='URL or path of city.list.json(.gz)')
+
+    def handle(self, *args, **options):
+        source = options['source']
+        if source.startswith(('http://', 'https://')):
+            response = get_session().get(source, timeout=(settings.OPEN_WEATHER_CONNECT_TIMEOUT, 120))
+            response.raise_for_status()
+            data = response.content
+        else:
+            with open(source, 'rb') as f:
+                data = f.read()
+        count = write_catalog(read_city_list(data), settings.CITY_CATALOG_PATH)
+        city_catalog.reload()
+        self.stdout.write(f'Loaded {count} cities into {settings.CITY_CATALOG_PATH}')
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from weather_app.client import weather_api_get
+from weather_app.models import City
+
+
+class Command(BaseCommand):
+    help = 'Fill in missing OpenWeatherMap ids of cities'
+
+    def handle(self, *args, **options):
+        resolved = 0
+        for city in City.objects.filter(owm_id__isnull=True).iterator():
+            response = weather_api_get(settings.OPEN_WEATHER_API_URL, q=city.name)
+            if response.status_code != 200:
+                self.stderr.write(f'Could not resolve {city.name}')
+                continue
+            owm_id = response.json()['id']
+            if not City.objects.filter(owm_id=owm_id).exists():
+                City.objects.filter(id=city.id).update(owm_id=owm_id)
+                resolved += 1
+        self.stdout.write(f'Resolved {resolved} cities')
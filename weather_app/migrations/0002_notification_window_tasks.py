@@ -0,0 +1,54 @@
+import json
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def per_period_tasks(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    IntervalSchedule = apps.get_model('django_celery_beat', 'IntervalSchedule')
+    Subscription = apps.get_model('weather_app', 'Subscription')
+    PeriodicTask.objects.filter(task='send_email_task').delete()
+    periods = Subscription.objects.values_list('period_notifications', flat=True).distinct()
+    for period in periods:
+        schedule, created = IntervalSchedule.objects.get_or_create(every=period, period='hours')
+        PeriodicTask.objects.get_or_create(
+            name=f'Send notifications every {period} hours',
+            defaults={
+                'task': 'dispatch_notifications_task',
+                'interval': schedule,
+                'args': json.dumps([period]),
+                'start_time': timezone.now(),
+            }
+        )
+
+
+def per_subscription_tasks(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    IntervalSchedule = apps.get_model('django_celery_beat', 'IntervalSchedule')
+    Subscription = apps.get_model('weather_app', 'Subscription')
+    PeriodicTask.objects.filter(task='dispatch_notifications_task').delete()
+    for subscription in Subscription.objects.select_related('user'):
+        schedule, created = IntervalSchedule.objects.get_or_create(
+            every=subscription.period_notifications,
+            period='hours'
+        )
+        PeriodicTask.objects.create(
+            name=f'Send email to {subscription.user.email}',
+            task='send_email_task',
+            interval=schedule,
+            args=json.dumps([subscription.id]),
+            start_time=timezone.now()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_celery_beat', '0015_edit_solarschedule_events_choices'),
+        ('weather_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(per_period_tasks, per_subscription_tasks),
+    ]
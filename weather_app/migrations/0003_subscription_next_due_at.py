@@ -0,0 +1,69 @@
+import json
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+NOTIFICATION_TASKS = ('send_email_task', 'dispatch_notifications_task')
+
+
+def next_run(task, now):
+    interval = timedelta(hours=task.interval.every)
+    last_run = task.last_run_at or task.start_time or now
+    next_due_at = last_run + interval
+    if next_due_at <= now:
+        next_due_at = now + interval
+    return next_due_at
+
+
+def periodic_tasks_to_next_due_at(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    Subscription = apps.get_model('weather_app', 'Subscription')
+    now = timezone.now()
+    tasks = PeriodicTask.objects.filter(task__in=NOTIFICATION_TASKS, interval__isnull=False).select_related('interval')
+    for task in tasks:
+        arg = json.loads(task.args)[0]
+        if task.task == 'send_email_task':
+            subscriptions = Subscription.objects.filter(id=arg)
+        else:
+            subscriptions = Subscription.objects.filter(period_notifications=arg)
+        subscriptions.filter(next_due_at__isnull=True).update(next_due_at=next_run(task, now))
+    for subscription in Subscription.objects.filter(next_due_at__isnull=True):
+        subscription.next_due_at = now + timedelta(hours=subscription.period_notifications)
+        subscription.save(update_fields=['next_due_at'])
+    PeriodicTask.objects.filter(task__in=NOTIFICATION_TASKS).delete()
+
+
+def next_due_at_to_periodic_tasks(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    IntervalSchedule = apps.get_model('django_celery_beat', 'IntervalSchedule')
+    Subscription = apps.get_model('weather_app', 'Subscription')
+    periods = Subscription.objects.values_list('period_notifications', flat=True).distinct()
+    for period in periods:
+        schedule, created = IntervalSchedule.objects.get_or_create(every=period, period='hours')
+        PeriodicTask.objects.get_or_create(
+            name=f'Send notifications every {period} hours',
+            defaults={
+                'task': 'dispatch_notifications_task',
+                'interval': schedule,
+                'args': json.dumps([period]),
+                'start_time': timezone.now(),
+            }
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_celery_beat', '0015_edit_solarschedule_events_choices'),
+        ('weather_app', '0002_notification_window_tasks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='next_due_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(periodic_tasks_to_next_due_at, next_due_at_to_periodic_tasks),
+    ]
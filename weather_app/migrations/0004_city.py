@@ -0,0 +1,29 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather_app', '0003_subscription_next_due_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='City',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owm_id', models.PositiveIntegerField(blank=True, null=True, unique=True)),
+                ('name', models.CharField(max_length=64)),
+                ('normalized_name', models.CharField(max_length=64, unique=True)),
+            ],
+            options={
+                'verbose_name_plural': 'cities',
+            },
+        ),
+        migrations.AddField(
+            model_name='cityinsubscription',
+            name='city',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='subscriptions', to='weather_app.city'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations
+
+
+def normalize_city(city_name):
+    return ' '.join(city_name.split()).lower()
+
+
+def resolve_city_names(apps, schema_editor):
+    City = apps.get_model('weather_app', 'City')
+    CityInSubscription = apps.get_model('weather_app', 'CityInSubscription')
+    cities = {}
+    seen = set()
+    for city_in_subscription in CityInSubscription.objects.order_by('id'):
+        normalized_name = normalize_city(city_in_subscription.name)
+        if (city_in_subscription.subscription_id, normalized_name) in seen:
+            city_in_subscription.delete()
+            continue
+        seen.add((city_in_subscription.subscription_id, normalized_name))
+        if normalized_name not in cities:
+            cities[normalized_name], created = City.objects.get_or_create(
+                normalized_name=normalized_name,
+                defaults={'name': ' '.join(city_in_subscription.name.split())},
+            )
+        city_in_subscription.city = cities[normalized_name]
+        city_in_subscription.save(update_fields=['city'])
+
+
+class Migration(migrations.Migration):
+    # data only, so the deferred foreign key checks run before 0006 alters the table
+
+    dependencies = [
+        ('weather_app', '0004_city'),
+    ]
+
+    operations = [
+        migrations.RunPython(resolve_city_names, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather_app', '0005_resolve_city_names'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cityinsubscription',
+            name='city',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='subscriptions', to='weather_app.city'),
+        ),
+        migrations.AddConstraint(
+            model_name='cityinsubscription',
+            constraint=models.UniqueConstraint(fields=('subscription', 'city'), name='unique_city_in_subscription'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2 on 2026-10-18 17:04
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_framework_api_key', '0004_prefix_hashed_key'),
+        ('weather_app', '0006_city_required'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedAPIKey',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('rest_framework_api_key.apikey',),
+        ),
+    ]
@@ -1,10 +1,15 @@
-import json
+from datetime import timedelta
 
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Exists, F, OuterRef, Q, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
-from django_celery_beat.models import PeriodicTask, IntervalSchedule
+from rest_framework_api_key.models import APIKey, APIKeyManager
+
+from weather_app.cache import normalize_city, response_cache, token_users, verified_keys
 
 
 class User(AbstractUser):
@@ -29,45 +34,320 @@ class Subscription(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     period_notifications = models.IntegerField(choices=Period.choices)
     date_of_subscription = models.DateTimeField(auto_now_add=True)
+    next_due_at = models.DateTimeField(null=True, blank=True, db_index=True)
 
     def __str__(self):
         return f'{self.user} has a subscription since {self.date_of_subscription} ' \
                f'with period of notifications - {self.period_notifications} hours.'
 
+    def delete(self, *args, **kwargs):
+        # cities deleted through the related manager know their subscription, the cascade would look up each one
+        with transaction.atomic():
+            self.cities.all().delete()
+            return super().delete(*args, **kwargs)
+
+
+class CityManager(models.Manager):
+
+    def get_for_name(self, name, owm_id=None):
+        key = normalize_city(name)
+        if owm_id is not None:
+            # another spelling of a city the provider already identified maps to that city
+            cities = self.filter(Q(owm_id=owm_id) | Q(normalized_name=key))
+            cities = sorted(cities, key=lambda city: city.owm_id != owm_id)
+            if cities:
+                return self._with_owm_id(cities[0], owm_id)
+        city, created = self.get_or_create(
+            normalized_name=key,
+            defaults={'name': ' '.join(name.split()), 'owm_id': owm_id},
+        )
+        return self._with_owm_id(city, owm_id)
+
+    def _with_owm_id(self, city, owm_id):
+        if owm_id is not None and city.owm_id is None:
+            self.filter(id=city.id).update(owm_id=owm_id)
+            city.owm_id = owm_id
+        return city
+
+    def get_for_names(self, owm_ids):
+        names = {normalize_city(name): name for name in owm_ids}
+        cities = {city.normalized_name: city for city in self.filter(normalized_name__in=names)}
+        missing = {key: name for key, name in names.items() if key not in cities}
+        if missing:
+            self.bulk_create([
+                self.model(name=' '.join(name.split()), normalized_name=key, owm_id=owm_ids[name])
+                for key, name in missing.items()
+            ], ignore_conflicts=True)
+            cities.update(self._find_created(missing, owm_ids))
+        return cities
+
+    def _find_created(self, missing, owm_ids):
+        # spellings that lost the insert to another one with the same provider id map to that city
+        keys_by_id = {}
+        for key, name in missing.items():
+            keys_by_id.setdefault(owm_ids[name], []).append(key)
+        cities = {}
+        for city in self.filter(Q(normalized_name__in=missing) | Q(owm_id__in=keys_by_id)):
+            keys = [city.normalized_name] + keys_by_id.get(city.owm_id, [])
+            cities.update({key: city for key in keys if key in missing})
+        return cities
+
+
+class City(models.Model):
+    owm_id = models.PositiveIntegerField(unique=True, null=True, blank=True)
+    name = models.CharField(max_length=64)
+    normalized_name = models.CharField(max_length=64, unique=True)
+
+    objects = CityManager()
+
+    class Meta:
+        verbose_name_plural = 'cities'
+
+    def __str__(self):
+        return f'{self.name}'
+
 
 class CityInSubscription(models.Model):
     subscription = models.ForeignKey(Subscription, on_delete=models.CASCADE, related_name='cities')
+    city = models.ForeignKey(City, on_delete=models.PROTECT, related_name='subscriptions')
     name = models.CharField(max_length=64)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['subscription', 'city'], name='unique_city_in_subscription'),
+        ]
+
     def __str__(self):
         return f'{self.name}'
 
+    def save(self, *args, **kwargs):
+        if self.city_id is None:
+            self.city = City.objects.get_for_name(self.name)
+        super().save(*args, **kwargs)
 
-def create_task(subscription):
-    schedule, created = IntervalSchedule.objects.get_or_create(
-        every=subscription.period_notifications,
-        period=IntervalSchedule.HOURS
-    )
-    task = PeriodicTask.objects.create(
-        name=f'Send email to {subscription.user.email}',
-        task='send_email_task',
-        interval=schedule,
-        args=json.dumps([subscription.id]),
-        start_time=timezone.now()
+
+class OutboxMessage(models.Model):
+    """A rendered notification waiting to be sent, at most one per subscription and window."""
+
+    class Status(models.IntegerChoices):
+        PENDING = 0
+        SENT = 1
+        FAILED = 2
+
+    subscription = models.ForeignKey(Subscription, on_delete=models.CASCADE, related_name='outbox')
+    idempotency_key = models.CharField(max_length=64, unique=True)
+    email = models.EmailField()
+    html_content = models.TextField()
+    status = models.PositiveSmallIntegerField(choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['available_at'], condition=Q(status=0), name='outbox_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.idempotency_key} to {self.email}'
+
+
+class CachedAPIKeyManager(APIKeyManager):
+
+    def is_valid(self, key):
+        generation = verified_keys.generation()
+        if verified_keys.is_verified(key, generation):
+            return True
+        try:
+            api_key = self.get_from_key(key)
+        except self.model.DoesNotExist:
+            return False
+        if api_key.has_expired:
+            return False
+        verified_keys.add(key, generation, self.lifetime(api_key))
+        return True
+
+    def lifetime(self, api_key):
+        if api_key.expiry_date is None:
+            return None
+        return (api_key.expiry_date - timezone.now()).total_seconds()
+
+
+class CachedAPIKey(APIKey):
+    objects = CachedAPIKeyManager()
+
+    class Meta:
+        proxy = True
+
+
+@receiver(post_save, sender=APIKey)
+@receiver(post_save, sender=CachedAPIKey)
+def api_key_saved(sender, instance, created, **kwargs):
+    if not created:
+        verified_keys.invalidate()
+
+
+@receiver(post_delete, sender=APIKey)
+@receiver(post_delete, sender=CachedAPIKey)
+def api_key_deleted(sender, instance, **kwargs):
+    verified_keys.invalidate()
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    if not created:
+        token_users.invalidate(instance.id)
+        response_cache.bump(instance.id)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    token_users.invalidate(instance.id)
+
+
+@receiver(post_save, sender=Subscription)
+def subscription_saved(sender, instance, created, **kwargs):
+    if created:
+        token_users.invalidate(instance.user_id)
+    response_cache.bump(instance.user_id)
+
+
+@receiver(post_delete, sender=Subscription)
+def subscription_deleted(sender, instance, **kwargs):
+    token_users.invalidate(instance.user_id)
+    response_cache.bump(instance.user_id)
+
+
+@receiver(post_save, sender=CityInSubscription)
+@receiver(post_delete, sender=CityInSubscription)
+def city_in_subscription_changed(sender, instance, **kwargs):
+    response_cache.bump(instance.subscription.user_id)
+
+
+def subscription_filter(user):
+    """Selects rows of the user's subscription, without a join when authentication resolved its id."""
+    if hasattr(user, 'subscription_id'):
+        return Q(subscription=user.subscription_id)
+    return Q(subscription__user=user.id)
+
+
+def get_subscription_for_city(user_id, city_name):
+    has_city = CityInSubscription.objects.filter(
+        subscription=OuterRef('pk'),
+        city__normalized_name=normalize_city(city_name),
     )
-    task.save()
+    return Subscription.objects.annotate(has_city=Exists(has_city)).get(user=user_id)
+
+
+def add_city(subscription, city_name, owm_id):
+    """Returns None when the subscription already has the city under another spelling."""
+    city = City.objects.get_for_name(city_name, owm_id=owm_id)
+    if subscription.cities.filter(city=city).exists():
+        return None
+    return CityInSubscription.objects.create(subscription=subscription, city=city, name=city_name)
+
+
+def update_cities(user_id, add, owm_ids, remove=(), replace=False):
+    """
+    Adds and removes cities of the user's subscription in one transaction and
+    returns the resulting cities. With ``replace`` the subscription ends up
+    with exactly the ``add`` cities.
+    """
+    add = {normalize_city(name): name for name in add}
+    remove = {normalize_city(name) for name in remove}
+    with transaction.atomic():
+        subscription = Subscription.objects.select_for_update().get(user=user_id)
+        current = {entry.city_id: entry for entry in subscription.cities.select_related('city')}
+        cities = resolve_cities(current.values(), add, owm_ids)
+        kept = {city.id for city in cities.values()}
+        removed = [
+            current.pop(city_id).id for city_id in list(current)
+            if city_id not in kept and (replace or current[city_id].city.normalized_name in remove)
+        ]
+        if removed:
+            subscription.cities.filter(id__in=removed).delete()
+        created = add_cities(subscription, add, cities, exclude=current)
+    return list(current.values()) + created
+
+
+def resolve_cities(entries, names, owm_ids):
+    """Maps normalized names to cities, reusing the subscribed ones."""
+    known = {entry.city.normalized_name: entry.city for entry in entries}
+    missing = [name for key, name in names.items() if key not in known]
+    if missing:
+        known.update(City.objects.get_for_names({name: owm_ids.get(name) for name in missing}))
+    return {key: known[key] for key in names}
+
+
+def add_cities(subscription, names, cities, exclude=()):
+    # spellings of one city and cities the subscription already has are added once, or not at all
+    entries = {}
+    for key, name in names.items():
+        city = cities[key]
+        if city.id not in exclude:
+            entries.setdefault(city.id, CityInSubscription(subscription=subscription, city=city, name=name))
+    return CityInSubscription.objects.bulk_create(list(entries.values()))
+
+
+def create_task(subscription, commit=True):
+    subscription.next_due_at = timezone.now() + timedelta(hours=int(subscription.period_notifications))
+    if commit:
+        Subscription.objects.filter(id=subscription.id).update(next_due_at=subscription.next_due_at)
     return
 
 
-def edit_task(subscription):
-    task = PeriodicTask.objects.filter(name=f'Send email to {subscription.user.email}').first()
-    task.interval.every = subscription.period_notifications
-    task.interval.save()
-    task.save()
+def edit_task(subscription, commit=True):
+    create_task(subscription, commit)
     return
 
 
-def delete_task(subscription):
-    task = PeriodicTask.objects.filter(name=f'Send email to {subscription.user.email}').first()
-    task.delete()
+def delete_task(subscription, commit=True):
+    subscription.next_due_at = None
+    if commit:
+        Subscription.objects.filter(id=subscription.id).update(next_due_at=None)
     return
+
+
+def next_due_at_after(now):
+    whens = []
+    for period in Subscription.Period.values:
+        interval = timedelta(hours=period)
+        whens += [
+            When(period_notifications=period, next_due_at__gt=now - interval, then=F('next_due_at') + interval),
+            When(period_notifications=period, then=Value(now + interval)),
+        ]
+    return Case(*whens, output_field=models.DateTimeField())
+
+
+def claim_due_subscriptions(now, limit):
+    with transaction.atomic():
+        due = Subscription.objects.select_for_update(skip_locked=True).filter(next_due_at__lte=now)
+        sub_ids = list(due.order_by('next_due_at').values_list('id', flat=True)[:limit])
+        Subscription.objects.filter(id__in=sub_ids).update(next_due_at=next_due_at_after(now))
+    return sub_ids
+
+
+def outbox_key(subscription_id, window):
+    return f'{subscription_id}:{window}'
+
+
+def claim_outbox(now, limit, lease, keys=None):
+    """
+    Takes up to ``limit`` pending messages that are due, skipping rows other
+    senders hold, and hides them from other senders for ``lease`` seconds.
+    With ``keys`` only the messages with those idempotency keys are taken.
+    """
+    with transaction.atomic():
+        due = OutboxMessage.objects.select_for_update(skip_locked=True).filter(
+            status=OutboxMessage.Status.PENDING,
+            available_at__lte=now,
+        )
+        if keys is not None:
+            due = due.filter(idempotency_key__in=keys)
+        ids = list(due.order_by('available_at').values_list('id', flat=True)[:limit])
+        OutboxMessage.objects.filter(id__in=ids).update(
+            attempts=F('attempts') + 1,
+            available_at=now + timedelta(seconds=lease),
+        )
+    return list(OutboxMessage.objects.filter(id__in=ids))
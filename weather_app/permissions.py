@@ -0,0 +1,9 @@
+from rest_framework_api_key import permissions
+
+from weather_app.models import CachedAPIKey
+
+
+class HasAPIKey(permissions.HasAPIKey):
+    """HasAPIKey that skips the password hasher for keys verified shortly before."""
+
+    model = CachedAPIKey
@@ -0,0 +1,141 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from threading import Lock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django_redis import get_redis_connection
+from rest_framework.exceptions import Throttled
+
+RESERVE_SCRIPT = """
+local rate, capacity, max_wait = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = math.max(0, (1 - tokens) / rate)
+local granted = 0
+if wait <= max_wait then
+    tokens = tokens - 1
+    granted = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate + max_wait) + 1)
+return {granted, tostring(wait)}
+"""
+
+
+class RateLimitExceeded(Throttled):
+    default_detail = 'Weather provider quota is used up, try again later.'
+
+
+class LocalTokenBucket:
+    """In-process stand-in for RedisTokenBucket, used when the cache is not Redis."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self, max_wait):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                return False, wait
+            self._tokens -= 1
+            return True, wait
+
+
+class RedisTokenBucket:
+    """
+    Token bucket shared by every process through Redis. A granted token may
+    be borrowed from the future, the caller then waits until it is due.
+    """
+
+    def __init__(self, client, key, rate, capacity):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self._script = client.register_script(RESERVE_SCRIPT)
+
+    def reserve(self, max_wait):
+        granted, wait = self._script(keys=[self.key], args=[self.rate, self.capacity, max_wait])
+        return bool(int(granted)), float(wait)
+
+
+class UpstreamLimiter:
+    """Rate limit and call accounting for the weather provider API."""
+
+    def __init__(self, alias='default', key_prefix='upstream'):
+        self.alias = alias
+        self.key_prefix = key_prefix
+        self._bucket = None
+        self._lock = Lock()
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    @property
+    def bucket(self):
+        with self._lock:
+            if self._bucket is None:
+                self._bucket = self.create_bucket()
+            return self._bucket
+
+    def create_bucket(self):
+        rate = settings.OPEN_WEATHER_CALLS_PER_MINUTE / 60
+        capacity = settings.OPEN_WEATHER_BURST
+        try:
+            client = get_redis_connection(self.alias)
+        except NotImplementedError:
+            return LocalTokenBucket(rate, capacity)
+        return RedisTokenBucket(client, f'{self.key_prefix}:bucket', rate, capacity)
+
+    def reserve(self):
+        granted, wait = self.bucket.reserve(settings.OPEN_WEATHER_RATE_LIMIT_MAX_WAIT)
+        if not granted:
+            raise RateLimitExceeded(wait)
+        self.record_call()
+        return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = await sync_to_async(self.reserve, thread_sensitive=False)()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def record_call(self):
+        for key, timeout in self._counter_keys():
+            self.shared.add(key, 0, timeout=timeout)
+            self.shared.incr(key)
+
+    def usage(self):
+        (minute_key, _), (day_key, _) = self._counter_keys()
+        return {
+            'minute': {'used': self.shared.get(minute_key, 0), 'quota': settings.OPEN_WEATHER_CALLS_PER_MINUTE},
+            'day': {'used': self.shared.get(day_key, 0), 'quota': settings.OPEN_WEATHER_CALLS_PER_DAY},
+        }
+
+    def _counter_keys(self):
+        now = datetime.now(timezone.utc)
+        return (
+            (f'{self.key_prefix}:calls:{now:%Y%m%d%H%M}', 2 * 60),
+            (f'{self.key_prefix}:calls:{now:%Y%m%d}', 2 * 24 * 60 * 60),
+        )
+
+
+upstream_limiter = UpstreamLimiter()
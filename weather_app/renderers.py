@@ -0,0 +1,27 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Newline-delimited JSON, one line per item of a list."""
+
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        items = data if isinstance(data, list) else [data]
+        return b''.join(self.render_item(item) for item in items)
+
+    def render_item(self, item):
+        return json.dumps(item, ensure_ascii=False).encode() + b'\n'
+
+
+class EventStreamRenderer(NDJSONRenderer):
+    """Server-sent events, one event per item of a list."""
+
+    media_type = 'text/event-stream'
+    format = 'sse'
+
+    def render_item(self, item):
+        return b'data: ' + json.dumps(item, ensure_ascii=False).encode() + b'\n\n'
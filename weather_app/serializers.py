@@ -17,3 +17,12 @@ class SubscriptionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Subscription
         fields = ('user_email', 'period_notifications', 'cities')
+
+
+class CitySetSerializer(serializers.Serializer):
+    cities = serializers.ListField(child=serializers.CharField(max_length=64), max_length=100)
+
+
+class CityDiffSerializer(serializers.Serializer):
+    add = serializers.ListField(child=serializers.CharField(max_length=64), max_length=100, default=list)
+    remove = serializers.ListField(child=serializers.CharField(max_length=64), max_length=100, default=list)
@@ -0,0 +1,131 @@
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class StubServer:
+    """
+    Local stand-in for an upstream HTTP service, served from a background
+    thread on a free port. Received request bodies are kept in ``requests``.
+    Every answer can be delayed by ``latency`` seconds, and a share of them
+    given by ``error_rate`` fails with ``error_status``.
+    """
+
+    def __init__(self, handler_class, **options):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.server.stub = self
+        self.options = options
+        self.requests = []
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, body):
+        with self._lock:
+            self.requests.append(body)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    @property
+    def stub(self):
+        return self.server.stub
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def inject_faults(self):
+        options = self.stub.options
+        if options.get('latency'):
+            time.sleep(options['latency'])
+        if random.random() < options.get('error_rate', 0):
+            self.send_json(options.get('error_status', 503), {'message': 'Injected error'})
+            return True
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SendGridStubHandler(StubHandler):
+    """Accepts /v3/mail/send and answers 400 naming the personalizations of recipients in ``reject``."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.stub.record(body)
+        if self.inject_faults():
+            return
+        reject = set(self.stub.options.get('reject', ()))
+        errors = [
+            {'message': f"Invalid recipient {to['email']}", 'field': f'personalizations.{i}.to.{j}.email'}
+            for i, personalization in enumerate(body['personalizations'])
+            for j, to in enumerate(personalization['to']) if to['email'] in reject
+        ]
+        if errors:
+            self.send_json(400, {'errors': errors})
+        else:
+            self.send_response(202)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+
+def stub_reading(owm_id, name):
+    return {
+        'id': owm_id,
+        'name': name,
+        'main': {'temp': owm_id % 40 - 10, 'feels_like': owm_id % 40 - 12},
+        'weather': [{'description': ('clear sky', 'few clouds', 'light rain', 'snow')[owm_id % 4]}],
+        'wind': {'speed': owm_id % 15},
+    }
+
+
+class OpenWeatherStubHandler(StubHandler):
+    """Answers the current weather and group endpoints with readings generated from the city id or name."""
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        self.stub.record(self.path)
+        if self.inject_faults():
+            return
+        if url.path.endswith('/group'):
+            readings = [stub_reading(int(owm_id), f'City {owm_id}') for owm_id in params['id'][0].split(',')]
+            self.send_json(200, {'cnt': len(readings), 'list': readings})
+        else:
+            name = params['q'][0]
+            self.send_json(200, stub_reading(zlib.crc32(name.lower().encode()) % 10 ** 7, name))
+
+
+def sendgrid_stub(**options):
+    return StubServer(SendGridStubHandler, **options)
+
+
+def openweather_stub(**options):
+    return StubServer(OpenWeatherStubHandler, **options)
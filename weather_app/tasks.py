@@ -1,17 +1,54 @@
+import asyncio
+import logging
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed, wait
+from datetime import timedelta
+from itertools import islice
+
 import requests
-from celery import shared_task
-from decouple import config
+from asgiref.sync import sync_to_async
+from celery import chain, shared_task
+from django.conf import settings
+from django.db.models import Prefetch
+from django.utils import timezone
 
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+from weather_app.cache import SingleFlight, normalize_city, weather_cache
+from weather_app.client import (
+    ASYNC_TRANSPORT_ERRORS, WeatherApiError, check_response, weather_api_get, weather_api_get_async,
+)
+from weather_app.mail import content_batches, render_fragments, render_notification, send_batch
+from weather_app.models import (
+    City, CityInSubscription, OutboxMessage, Subscription, claim_due_subscriptions, claim_outbox, outbox_key,
+)
+from weather_app.ratelimit import RateLimitExceeded
 
-from WeatherReminder.settings import OPEN_WEATHER_API_URL
-from weather_app.models import Subscription, CityInSubscription
+logger = logging.getLogger(__name__)
 
+UPSTREAM_ERRORS = (requests.RequestException, *ASYNC_TRANSPORT_ERRORS, WeatherApiError, KeyError, ValueError)
 
-def get_weather(city_name):
-    url = OPEN_WEATHER_API_URL + f'?q={city_name}&units=metric&appid={config("weather_api_key")}'
-    data = requests.get(url).json()
+fetch_executor = ThreadPoolExecutor(max_workers=settings.WEATHER_FETCH_WORKERS, thread_name_prefix='weather-fetch')
+
+inflight = SingleFlight()
+inflight_async = weakref.WeakKeyDictionary()
+
+
+def fetch_weather(city_name):
+    response = check_response(weather_api_get(settings.OPEN_WEATHER_API_URL, q=city_name, units='metric'))
+    return parse_weather(response.json())
+
+
+def fetch_weather_group(owm_ids):
+    response = weather_api_get(settings.OPEN_WEATHER_GROUP_API_URL, id=','.join(map(str, owm_ids)), units='metric')
+    return {item['id']: parse_weather(item) for item in check_response(response).json()['list']}
+
+
+async def fetch_weather_async(city_name):
+    response = await weather_api_get_async(settings.OPEN_WEATHER_API_URL, q=city_name, units='metric')
+    return parse_weather(check_response(response).json())
+
+
+def parse_weather(data):
     weather_data = {
         'city': data['name'],
         'temperature': f"{data['main']['temp']}°C",
@@ -22,28 +59,417 @@ def get_weather(city_name):
     return weather_data
 
 
-@shared_task(name="send_email_task")
-def send_email_task(sub_id):
-    subscription = Subscription.objects.get(id=sub_id)
-    email = subscription.user.email
-    cities = [city.name for city in CityInSubscription.objects.filter(subscription=subscription)]
-    if len(cities) != 0:
-        html_content = ''
-        for city in cities:
-            weather = get_weather(city)
-            html_content += f'''<p>
-                                    <strong>{weather["city"]}</strong><br>
-                                    Temperature {weather["temperature"]}<br>
-                                    Feels like {weather["feels like"]}<br>
-                                    {weather["description"]}<br>
-                                    Wind speed {weather["wind speed"]}<br>
-                                </p>'''
-        sg = SendGridAPIClient(config('sendgrid_api_key'))
-        message = Mail(
-            from_email=config('from_email'),
-            to_emails=email,
-            subject='Weather notification',
-            html_content=html_content
-        )
-        sg.send(message)
+def get_weather(city_name):
+    entry = weather_cache.get_entry(city_name)
+    if entry is None:
+        return refresh_weather(city_name)
+    if not weather_cache.is_fresh(entry):
+        refresh_in_background([City(name=city_name, normalized_name=normalize_city(city_name))])
+    return weather_cache.reading(entry)
+
+
+def refresh_weather(city_name):
+    return inflight.do(normalize_city(city_name), lambda: store_weather(city_name, fetch_weather(city_name)))
+
+
+def store_weather(city_name, data):
+    weather_cache.set(city_name, data)
+    return data
+
+
+async def get_weather_async(city_name):
+    entry = await sync_to_async(weather_cache.get_entry, thread_sensitive=False)(city_name)
+    if entry is None:
+        return await refresh_weather_async(city_name)
+    if not weather_cache.is_fresh(entry):
+        city = City(name=city_name, normalized_name=normalize_city(city_name))
+        await sync_to_async(refresh_in_background, thread_sensitive=False)([city])
+    return weather_cache.reading(entry)
+
+
+async def refresh_weather_async(city_name):
+    flights = inflight_async.setdefault(asyncio.get_event_loop(), {})
+    key = normalize_city(city_name)
+    if key not in flights:
+        flights[key] = asyncio.ensure_future(fetch_and_store_async(city_name))
+        flights[key].add_done_callback(lambda task: flights.pop(key, None))
+    return await asyncio.shield(flights[key])
+
+
+async def fetch_and_store_async(city_name):
+    data = await fetch_weather_async(city_name)
+    return await sync_to_async(store_weather, thread_sensitive=False)(city_name, data)
+
+
+def split_cached(cities):
+    weather_by_city, missing, stale = {}, [], []
+    for city in cities:
+        entry = weather_cache.get_entry(city.name) if city.owm_id is not None else None
+        if entry is None:
+            missing.append(city)
+            continue
+        weather_by_city[city.normalized_name] = weather_cache.reading(entry)
+        if not weather_cache.is_fresh(entry):
+            stale.append(city)
+    return weather_by_city, missing, stale
+
+
+def plan_batches(cities):
+    with_ids = [city for city in cities if city.owm_id is not None]
+    limit = settings.OPEN_WEATHER_GROUP_LIMIT
+    batches = [with_ids[i:i + limit] for i in range(0, len(with_ids), limit)]
+    return batches + [[city] for city in cities if city.owm_id is None]
+
+
+def fetch_batch(cities):
+    if cities[0].owm_id is None:
+        return {cities[0].normalized_name: get_weather(cities[0].name)}
+    owned, pending = inflight.claim([city.normalized_name for city in cities])
+    try:
+        weather_by_city = fetch_group([city for city in cities if city.normalized_name in owned])
+    except Exception as e:
+        inflight.release(owned, {}, e)
+        raise
+    inflight.release(owned, weather_by_city)
+    return dict(weather_by_city, **in_flight_results(pending))
+
+
+def in_flight_results(pending):
+    return {key: future.result() for key, future in pending.items() if future.exception() is None}
+
+
+def fetch_group(cities):
+    if not cities:
+        return {}
+    fetched = fetch_weather_group([city.owm_id for city in cities])
+    return {
+        city.normalized_name: store_weather(city.name, fetched[city.owm_id])
+        for city in cities
+        if city.owm_id in fetched
+    }
+
+
+def refresh_in_background(cities):
+    cities = [city for city in cities if weather_cache.claim_refresh(city.name)]
+    for batch in plan_batches(cities):
+        fetch_executor.submit(refresh_batch, batch)
+
+
+def refresh_batch(cities):
+    try:
+        if cities[0].owm_id is None:
+            refresh_weather(cities[0].name)
+        else:
+            fetch_batch(cities)
+    except UPSTREAM_ERRORS as e:
+        logger.warning('Failed to refresh weather for %s: %s', ', '.join(city.name for city in cities), e)
+
+
+def get_weather_many(cities):
+    weather_by_city, missing, stale = split_cached(cities)
+    for batch in plan_batches(missing + stale):
+        try:
+            weather_by_city.update(fetch_batch(batch))
+        except UPSTREAM_ERRORS:
+            logger.exception('Failed to get weather for %s', ', '.join(city.name for city in batch))
+    return weather_by_city
+
+
+def get_weather_concurrently(cities, timeout):
+    weather_by_city, missing, stale = split_cached(cities)
+    refresh_in_background(stale)
+    futures = {fetch_executor.submit(fetch_batch, batch): batch for batch in plan_batches(missing)}
+    done, not_done = wait(futures, timeout=timeout)
+    for future in not_done:
+        future.cancel()
+    errors = {}
+    for future, batch in futures.items():
+        weather, error = future_result(future, done, ', '.join(city.name for city in batch))
+        weather_by_city.update(weather or {})
+        errors.update(dict.fromkeys([city.normalized_name for city in batch], error))
+    return [
+        weather_by_city.get(city.normalized_name)
+        or {'city': city.name, 'error': errors.get(city.normalized_name) or 'unavailable'}
+        for city in cities
+    ]
+
+
+def iter_weather(cities, timeout, chunk_size):
+    """
+    Yields the weather of each city as soon as it is known, cached readings
+    first, then every batch as its fetch completes. Cities are handled
+    ``chunk_size`` at a time, all within ``timeout`` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    for chunk in chunked(cities, chunk_size):
+        yield from iter_chunk_weather(chunk, deadline)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def iter_chunk_weather(cities, deadline):
+    weather_by_city, missing, stale = split_cached(cities)
+    if deadline <= time.monotonic():
+        # chunks after the deadline are answered from the cache without starting any fetch
+        yield from weather_by_city.values()
+        yield from batch_weather(missing, None, 'timeout')
         return
+    refresh_in_background(stale)
+    futures = {fetch_executor.submit(fetch_batch, batch): batch for batch in plan_batches(missing)}
+    yield from weather_by_city.values()
+    yield from iter_completed(futures, deadline)
+
+
+def iter_completed(futures, deadline):
+    pending = set(futures)
+    try:
+        for future in as_completed(futures, timeout=max(0, deadline - time.monotonic())):
+            pending.discard(future)
+            label = ', '.join(city.name for city in futures[future])
+            yield from batch_weather(futures[future], *future_result(future, {future}, label))
+    except FuturesTimeoutError:
+        pass
+    for future in pending:
+        future.cancel()
+        yield from batch_weather(futures[future], None, 'timeout')
+
+
+def batch_weather(cities, weather, error):
+    weather = weather or {}
+    for city in cities:
+        yield weather.get(city.normalized_name) or {'city': city.name, 'error': error or 'unavailable'}
+
+
+def future_result(future, done, label):
+    if future not in done:
+        return None, 'timeout'
+    try:
+        return future.result(), None
+    except RateLimitExceeded:
+        return None, 'rate_limited'
+    except UPSTREAM_ERRORS:
+        logger.exception('Failed to get weather for %s', label)
+        return None, 'unavailable'
+
+
+async def get_weather_concurrently_async(city_names, timeout):
+    tasks = [asyncio.ensure_future(get_weather_async(city_name)) for city_name in city_names]
+    if not tasks:
+        return []
+    done, not_done = await asyncio.wait(tasks, timeout=timeout)
+    for task in not_done:
+        task.cancel()
+    results = [future_result(task, done, city_name) for task, city_name in zip(tasks, city_names)]
+    return [weather or {'city': city_name, 'error': error} for (weather, error), city_name in zip(results, city_names)]
+
+
+def collect_cities(subscriptions):
+    cities = {}
+    for subscription in subscriptions:
+        for city_in_subscription in subscription.cities.all():
+            cities.setdefault(city_in_subscription.city.normalized_name, city_in_subscription.city)
+    return list(cities.values())
+
+
+def rendered_bodies(subscriptions, weather_by_city):
+    # joining the cached fragments costs less than looking up a body rendered for the same cities
+    fragments = render_fragments(weather_by_city)
+    for subscription in subscriptions:
+        cities = [city_in_subscription.city for city_in_subscription in subscription.cities.all()]
+        body = render_notification(cities, fragments)
+        if body:
+            yield subscription, body
+
+
+def notification_window(now):
+    return f'{now:%Y%m%d%H}'
+
+
+def write_outbox(subscriptions, weather_by_city, window):
+    """
+    Stores the rendered notifications. A subscription that already has a
+    message for the window keeps it, so a repeated run sends nothing twice.
+    """
+    messages = [
+        OutboxMessage(
+            subscription=subscription,
+            idempotency_key=outbox_key(subscription.id, window),
+            email=subscription.user.email,
+            html_content=body,
+        )
+        for subscription, body in rendered_bodies(subscriptions, weather_by_city)
+    ]
+    OutboxMessage.objects.bulk_create(messages, batch_size=settings.OUTBOX_BATCH_SIZE, ignore_conflicts=True)
+
+
+def deliver_outbox(messages):
+    # every request is settled as soon as it returns, so an error later in the batch cannot send it again
+    failed = []
+    for html_content, batch in content_batches(messages):
+        rejected = send_batch(html_content, batch)
+        settle_outbox(batch, {message.id: status_code for message, status_code in rejected}, timezone.now())
+        failed += rejected
+    return failed
+
+
+def settle_outbox(messages, failed, now):
+    sent = [message.id for message in messages if message.id not in failed]
+    OutboxMessage.objects.filter(id__in=sent).update(status=OutboxMessage.Status.SENT, sent_at=now)
+    retries = {}
+    for message in messages:
+        if message.id not in failed:
+            continue
+        if is_permanent(failed[message.id]) or message.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            retries.setdefault(None, []).append(message.id)
+        else:
+            retries.setdefault(message.attempts, []).append(message.id)
+    for attempts, ids in retries.items():
+        OutboxMessage.objects.filter(id__in=ids).update(**retry_fields(attempts, now))
+
+
+def is_permanent(status_code):
+    return status_code is not None and 400 <= status_code < 500 and status_code != 429
+
+
+def retry_fields(attempts, now):
+    if attempts is None:
+        return {'status': OutboxMessage.Status.FAILED}
+    return {'available_at': now + timedelta(seconds=settings.OUTBOX_RETRY_DELAY * 2 ** (attempts - 1))}
+
+
+def drain_outbox(keys=None):
+    failed = []
+    messages = claim_outbox(timezone.now(), settings.OUTBOX_BATCH_SIZE, settings.OUTBOX_LEASE, keys)
+    while messages:
+        failed += deliver_outbox(messages)
+        messages = claim_outbox(timezone.now(), settings.OUTBOX_BATCH_SIZE, settings.OUTBOX_LEASE, keys)
+    return failed
+
+
+def with_cities(subscriptions):
+    cities = Prefetch('cities', queryset=CityInSubscription.objects.select_related('city'))
+    return subscriptions.prefetch_related(cities)
+
+
+def report_failed(failed):
+    for notification, status_code in failed:
+        logger.error('Weather notification to %s was not delivered (%s)', notification.email, status_code)
+    return failed
+
+
+def send_notifications(subscriptions, window=None):
+    subscriptions = list(with_cities(subscriptions.select_related('user')))
+    weather_by_city = get_weather_many(collect_cities(subscriptions))
+    window = window or notification_window(timezone.now())
+    write_outbox(subscriptions, weather_by_city, window)
+    # only this run's messages, the rest of the outbox belongs to the sender workers
+    return report_failed(drain_outbox([outbox_key(subscription.id, window) for subscription in subscriptions]))
+
+
+def notification_pipeline(sub_ids, window):
+    return chain(
+        fetch_weather_task.s(sub_ids),
+        render_notifications_task.s(sub_ids, window),
+        drain_outbox_task.si(),
+    )
+
+
+@shared_task(name="dispatch_due_notifications_task")
+def dispatch_due_notifications_task():
+    now = timezone.now()
+    sub_ids = claim_due_subscriptions(now, settings.NOTIFICATIONS_DISPATCH_BATCH_SIZE)
+    while sub_ids:
+        notification_pipeline(sub_ids, notification_window(now)).delay()
+        sub_ids = claim_due_subscriptions(now, settings.NOTIFICATIONS_DISPATCH_BATCH_SIZE)
+
+
+def cities_due_between(start, end):
+    due = City.objects.filter(
+        subscriptions__subscription__next_due_at__gt=start,
+        subscriptions__subscription__next_due_at__lte=end,
+    )
+    return list(due.distinct())
+
+
+def warming_spacing():
+    calls_per_second = settings.OPEN_WEATHER_CALLS_PER_MINUTE * settings.WEATHER_WARMING_QUOTA_SHARE / 60
+    return 1 / calls_per_second
+
+
+@shared_task(name="warm_weather_cache_task")
+def warm_weather_cache_task():
+    """
+    Queues fetches for cities of subscriptions that come within the lead time
+    since the last run, paced to a share of the upstream quota. A run never
+    outlasts the interval, so runs do not overlap and add up past the share.
+    """
+    horizon = timezone.now() + timedelta(seconds=settings.WEATHER_WARMING_LEAD_TIME)
+    cities = cities_due_between(horizon - timedelta(seconds=settings.WEATHER_WARMING_INTERVAL), horizon)
+    cities = [city for city in cities if (weather_cache.fresh_until(city.name) or 0) < horizon.timestamp()]
+    batches = plan_batches(cities)
+    spacing = warming_spacing()
+    limit = max(int(settings.WEATHER_WARMING_INTERVAL / spacing), 1)
+    if len(batches) > limit:
+        logger.warning('Warming %d of %d batches, the rest is fetched at delivery', limit, len(batches))
+    for i, batch in enumerate(batches[:limit]):
+        warm_cities_task.apply_async(([city.id for city in batch],), countdown=round(i * spacing, 2))
+
+
+@shared_task(bind=True, name="warm_cities_task")
+def warm_cities_task(self, city_ids):
+    try:
+        for batch in plan_batches(list(City.objects.filter(id__in=city_ids))):
+            refresh_batch(batch)
+    except RateLimitExceeded as e:
+        raise self.retry(countdown=e.wait, max_retries=None)
+
+
+@shared_task(bind=True, name="fetch_weather_task")
+def fetch_weather_task(self, sub_ids):
+    try:
+        return get_weather_many(collect_cities(with_cities(Subscription.objects.filter(id__in=sub_ids))))
+    except RateLimitExceeded as e:
+        raise self.retry(countdown=e.wait, max_retries=None)
+
+
+@shared_task(name="render_notifications_task")
+def render_notifications_task(weather_by_city, sub_ids, window=None):
+    subscriptions = with_cities(Subscription.objects.filter(id__in=sub_ids).select_related('user'))
+    write_outbox(subscriptions, weather_by_city, window or notification_window(timezone.now()))
+
+
+@shared_task(name="drain_outbox_task")
+def drain_outbox_task():
+    """
+    Sends one batch from the outbox. A full batch queues the next drain
+    first, so every free sender worker takes a batch of its own.
+    """
+    messages = claim_outbox(timezone.now(), settings.OUTBOX_BATCH_SIZE, settings.OUTBOX_LEASE)
+    if len(messages) == settings.OUTBOX_BATCH_SIZE:
+        drain_outbox_task.delay()
+    if messages:
+        report_failed(deliver_outbox(messages))
+
+
+@shared_task(name="sweep_outbox_task")
+def sweep_outbox_task():
+    now = timezone.now()
+    OutboxMessage.objects.filter(
+        status__in=[OutboxMessage.Status.SENT, OutboxMessage.Status.FAILED],
+        created_at__lt=now - timedelta(seconds=settings.OUTBOX_RETENTION),
+    ).delete()
+    drain_outbox_task.delay()
+
+
+@shared_task(bind=True, name="send_email_task")
+def send_email_task(self, sub_id):
+    try:
+        send_notifications(Subscription.objects.filter(id=sub_id))
+    except RateLimitExceeded as e:
+        raise self.retry(countdown=e.wait, max_retries=None)
@@ -1,12 +1,57 @@
-from unittest.mock import patch
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.client import RemoteDisconnected
+from unittest.mock import AsyncMock, Mock, patch
 
-from django.test import TestCase
+from asgiref.testing import ApplicationCommunicator
+from celery.exceptions import Retry
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import AsyncClient, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from python_http_client.exceptions import HTTPError
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_api_key.models import APIKey
+from rest_framework_simplejwt.tokens import AccessToken
 
-from weather_app.models import User, Subscription, CityInSubscription
-from weather_app.tasks import send_email_task
+from WeatherReminder.celery import app as celery_app
+from weather_app.admin import EstimatedCountPaginator
+from weather_app.cache import LRUCache, WeatherCache, response_cache, verified_keys, weather_cache
+from weather_app.catalog import (
+    CatalogCity, CityCatalog, CityLookupUnavailable, city_id_key, find_city_id, find_city_ids, read_city_list,
+    write_catalog,
+)
+from weather_app.client import (
+    CircuitBreaker, CircuitOpen, WeatherApiError, close_async_client, get_async_client, get_session, weather_api_get,
+    weather_api_get_async,
+)
+from weather_app.mail import (
+    Notification, content_batches, fragment_cache, get_sendgrid_client, render_fragments, render_notification,
+    send_batch,
+)
+from weather_app.models import (
+    User, Subscription, City, CityInSubscription, CachedAPIKey, OutboxMessage, claim_due_subscriptions, claim_outbox,
+    create_task, delete_task,
+)
+from weather_app.ratelimit import LocalTokenBucket, RateLimitExceeded, UpstreamLimiter
+from weather_app.stubs import openweather_stub, sendgrid_stub
+from weather_app.tasks import (
+    dispatch_due_notifications_task, drain_outbox_task, fetch_executor, fetch_weather, fetch_weather_group,
+    fetch_weather_task, get_weather, get_weather_concurrently, get_weather_many, iter_weather, notification_pipeline,
+    refresh_in_background, render_notifications_task, send_email_task, send_notifications,
+    warm_cities_task, warm_weather_cache_task,
+)
 
 
 class MySubscriptionTestCase(APITestCase):
@@ -92,7 +137,18 @@ class MyCitiesInSubscriptionTestCase(APITestCase):
         self.client.force_authenticate(self.user)
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, [{'name': 'London'}, {'name': 'Berlin'}])
+        self.assertEqual(response.data['results'], [{'name': 'London'}, {'name': 'Berlin'}])
+
+    @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+    def test_list_cities_is_cursor_paginated(self, mock_has_permission):
+        CityInSubscription.objects.create(subscription=self.subscription, name='Kyiv')
+        self.client.force_authenticate(self.user)
+        response = self.client.get(self.url, {'page_size': 2})
+        self.assertEqual(response.data['results'], [{'name': 'London'}, {'name': 'Berlin'}])
+        self.assertIn('cursor=', response.data['next'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'], [{'name': 'Kyiv'}])
+        self.assertIsNone(response.data['next'])
 
     @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
     def test_create_added_city(self, mock_has_permission):
@@ -105,6 +161,33 @@ class MyCitiesInSubscriptionTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data, 'City already added in your subscription')
 
+    @patch('weather_app.views.find_city_id')
+    @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+    def test_create_added_city_other_spelling(self, mock_has_permission, mock_find_city_id):
+        self.client.force_authenticate(self.user)
+        response = self.client.post(self.url, data={'name': ' london'})
+        self.assertEqual(response.data, 'City already added in your subscription')
+        mock_find_city_id.assert_not_called()
+
+    @patch('weather_app.views.find_city_id', return_value=703448)
+    @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+    def test_create_city_stores_provider_id(self, mock_has_permission, mock_find_city_id):
+        self.client.force_authenticate(self.user)
+        response = self.client.post(self.url, data={'name': 'Kyiv'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(City.objects.get(normalized_name='kyiv').owm_id, 703448)
+
+    @patch('weather_app.views.find_city_id', return_value=703448)
+    @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+    def test_create_added_city_with_same_provider_id(self, mock_has_permission, mock_find_city_id):
+        kyiv = City.objects.create(name='Kyiv', normalized_name='kyiv', owm_id=703448)
+        CityInSubscription.objects.create(subscription=self.subscription, city=kyiv, name='Kyiv')
+        self.client.force_authenticate(self.user)
+        response = self.client.post(self.url, data={'name': 'Kiev'})
+        self.assertEqual(response.data, 'City already added in your subscription')
+        self.assertEqual(self.subscription.cities.filter(city=kyiv).count(), 1)
+        self.assertFalse(City.objects.filter(normalized_name='kiev').exists())
+
     @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
     def test_create_non_existent_city(self, mock_has_permission):
         data_subscription = {
@@ -128,6 +211,89 @@ class MyCitiesInSubscriptionTestCase(APITestCase):
         self.assertEqual(response.data, {'name': data_subscription['name']})
 
 
+class BulkCitiesTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='test@test.com', password='test_password')
+        self.subscription = Subscription.objects.create(user=self.user, period_notifications=3)
+        CityInSubscription.objects.create(subscription=self.subscription, name='London')
+        CityInSubscription.objects.create(subscription=self.subscription, name='Berlin')
+        self.url = reverse('cities_bulk')
+        self.client.force_authenticate(self.user)
+        patcher = patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def subscribed(self):
+        return sorted(self.subscription.cities.values_list('city__normalized_name', flat=True))
+
+    @patch('weather_app.views.find_city_ids', side_effect=lambda names: {name: 1 + len(name) for name in names})
+    def test_put_replaces_cities(self, mock_find_city_ids):
+        response = self.client.put(self.url, data={'cities': ['berlin', 'Kyiv', 'Paris']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [{'name': 'Berlin'}, {'name': 'Kyiv'}, {'name': 'Paris'}])
+        self.assertEqual(self.subscribed(), ['berlin', 'kyiv', 'paris'])
+        mock_find_city_ids.assert_called_once_with(['Kyiv', 'Paris'])
+        self.assertEqual(City.objects.get(normalized_name='kyiv').owm_id, 5)
+
+    @patch('weather_app.views.find_city_ids', side_effect=lambda names: {name: 1 + len(name) for name in names})
+    def test_patch_applies_diff(self, mock_find_city_ids):
+        response = self.client.patch(self.url, data={'add': ['Oslo', 'Berlin'], 'remove': [' london']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.subscribed(), ['berlin', 'oslo'])
+        mock_find_city_ids.assert_called_once_with(['Oslo'])
+
+    @patch('weather_app.views.find_city_ids', return_value={'Oslo': 3143244, 'Atlantis': None})
+    def test_unknown_city_rejects_whole_request(self, mock_find_city_ids):
+        response = self.client.put(self.url, data={'cities': ['Oslo', 'Atlantis']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {'unknown_cities': ['Atlantis']})
+        self.assertEqual(self.subscribed(), ['berlin', 'london'])
+
+    @patch('weather_app.views.find_city_ids', return_value={'Kiev': 703448, 'Kyiv': 703448})
+    def test_put_adds_spellings_of_one_city_once(self, mock_find_city_ids):
+        response = self.client.put(self.url, data={'cities': ['Kiev', 'Kyiv']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(self.subscription.cities.get().city.owm_id, 703448)
+
+    @patch('weather_app.views.find_city_ids', return_value={'Kiev': 703448})
+    def test_patch_skips_other_spelling_of_subscribed_city(self, mock_find_city_ids):
+        kyiv = City.objects.create(name='Kyiv', normalized_name='kyiv', owm_id=703448)
+        CityInSubscription.objects.create(subscription=self.subscription, city=kyiv, name='Kyiv')
+        response = self.client.patch(self.url, data={'add': ['Kiev']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.subscribed(), ['berlin', 'kyiv', 'london'])
+
+    @patch('weather_app.views.find_city_ids', return_value={'Kiev': 703448})
+    def test_put_keeps_subscribed_city_under_other_spelling(self, mock_find_city_ids):
+        kyiv = City.objects.create(name='Kyiv', normalized_name='kyiv', owm_id=703448)
+        entry = CityInSubscription.objects.create(subscription=self.subscription, city=kyiv, name='Kyiv')
+        response = self.client.put(self.url, data={'cities': ['Kiev']}, format='json')
+        self.assertEqual(response.data, [{'name': 'Kyiv'}])
+        self.assertEqual(list(self.subscription.cities.values_list('id', flat=True)), [entry.id])
+
+    def test_spellings_with_same_provider_id_share_a_city(self):
+        City.objects.create(name='Kiev', normalized_name='kiev', owm_id=703448)
+        cities = City.objects.get_for_names({'Kyiv': 703448, 'Oslo': 3143244, 'Kyyiv': 703448})
+        self.assertEqual(cities['kyiv'].name, 'Kiev')
+        self.assertEqual(cities['kyyiv'].name, 'Kiev')
+        self.assertEqual(cities['oslo'].owm_id, 3143244)
+
+    @patch('weather_app.catalog.fetch_city_id', side_effect=lambda name: {'Oslo': 3143244}.get(name))
+    def test_city_ids_are_validated_in_one_pass(self, mock_fetch_city_id):
+        cache.clear()
+        cache.set('city_id:paris', 2988507)
+        with patch('weather_app.catalog.city_catalog.lookup', side_effect=lambda name: CITY_CATALOG.get(name)):
+            city_ids = find_city_ids(['Kyiv', 'Paris', 'Oslo', 'Atlantis'])
+        self.assertEqual(city_ids, {'Kyiv': 703448, 'Paris': 2988507, 'Oslo': 3143244, 'Atlantis': None})
+        self.assertEqual(sorted(call.args[0] for call in mock_fetch_city_id.call_args_list), ['Atlantis', 'Oslo'])
+        self.assertEqual(cache.get('city_id:atlantis'), 0)
+
+
+CITY_CATALOG = {'Kyiv': CatalogCity(703448, 'Kyiv', 'UA')}
+
+
 class OneCityTestCase(APITestCase):
 
     def setUp(self):
@@ -175,6 +341,225 @@ class GetWeatherTestCase(APITestCase):
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    @patch('weather_app.views.settings.WEATHER_REQUEST_DEADLINE', 0.2)
+    @patch('weather_app.tasks.get_weather')
+    @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+    def test_get_weather_partial_results(self, mock_has_permission, mock_get_weather):
+        def slow_weather(city_name):
+            if city_name == 'Moscow':
+                time.sleep(1)
+            return {'city': city_name}
+
+        mock_get_weather.side_effect = slow_weather
+        self.client.force_authenticate(self.user)
+        started = time.monotonic()
+        response = self.client.get(self.url)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [{'city': 'Moscow', 'error': 'timeout'}, {'city': 'Berlin'}])
+
+    @patch('weather_app.tasks.get_weather')
+    @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+    def test_get_weather_upstream_error(self, mock_has_permission, mock_get_weather):
+        def failing_weather(city_name):
+            if city_name == 'Moscow':
+                raise KeyError('main')
+            return {'city': city_name}
+
+        mock_get_weather.side_effect = failing_weather
+        self.client.force_authenticate(self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [{'city': 'Moscow', 'error': 'unavailable'}, {'city': 'Berlin'}])
+
+    @patch('weather_app.views.settings.WEATHER_REQUEST_DEADLINE', 0.2)
+    @patch('weather_app.tasks.get_weather')
+    @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+    def test_get_weather_stream(self, mock_has_permission, mock_get_weather):
+        def slow_weather(city_name):
+            if city_name == 'Moscow':
+                time.sleep(1)
+            return {'city': city_name}
+
+        mock_get_weather.side_effect = slow_weather
+        self.client.force_authenticate(self.user)
+        response = self.client.get(self.url, HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines], [{'city': 'Berlin'}, {'city': 'Moscow', 'error': 'timeout'}],
+        )
+
+    @patch('weather_app.tasks.get_weather', side_effect=lambda city_name: {'city': city_name})
+    @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+    def test_get_weather_event_stream(self, mock_has_permission, mock_get_weather):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(self.url, {'format': 'sse'})
+        events = b''.join(response.streaming_content).decode().split('\n\n')
+        self.assertEqual(sorted(events), ['', 'data: {"city": "Berlin"}', 'data: {"city": "Moscow"}'])
+
+
+@patch('rest_framework_api_key.permissions.HasAPIKey.has_permission', return_value=True)
+class AsgiGetWeatherTestCase(TransactionTestCase):
+    """Requests through the ASGI handler, whose worker threads only see committed rows."""
+
+    def setUp(self):
+        self.user = User.objects.create(email='test@test.com', password='test_password')
+        subscription = Subscription.objects.create(user=self.user, period_notifications=3)
+        CityInSubscription.objects.create(subscription=subscription, name='Moscow')
+        CityInSubscription.objects.create(subscription=subscription, name='Berlin')
+        authenticate = patch(
+            'rest_framework_simplejwt.authentication.JWTAuthentication.authenticate',
+            return_value=(self.user, None),
+        )
+        authenticate.start()
+        self.addCleanup(authenticate.stop)
+
+    async def asgi_get(self, path, query_string):
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string, 'headers': [],
+        }
+        communicator = ApplicationCommunicator(get_asgi_application(), scope)
+        await communicator.send_input({'type': 'http.request'})
+        start = await communicator.receive_output(5)
+        body = b''
+        message = {'more_body': True}
+        while message.get('more_body'):
+            message = await communicator.receive_output(5)
+            body += message.get('body', b'')
+        return start['status'], body
+
+    @patch('weather_app.tasks.get_weather', side_effect=lambda city_name: {'city': city_name})
+    async def test_ndjson_under_asgi(self, mock_get_weather, mock_has_permission):
+        status_code, body = await self.asgi_get(reverse('get_weather'), b'format=ndjson')
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            sorted(json.loads(line)['city'] for line in body.splitlines()), ['Berlin', 'Moscow'],
+        )
+
+
+@patch('rest_framework_api_key.permissions.HasAPIKey.has_permission', return_value=True)
+class AsyncViewsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='test@test.com', password='test_password')
+        self.subscription = Subscription.objects.create(user=self.user, period_notifications=3)
+        CityInSubscription.objects.create(subscription=self.subscription, name='Moscow')
+        CityInSubscription.objects.create(subscription=self.subscription, name='Berlin')
+        self.async_client = AsyncClient()
+        authenticate = patch(
+            'rest_framework_simplejwt.authentication.JWTAuthentication.authenticate',
+            return_value=(self.user, None),
+        )
+        authenticate.start()
+        self.addCleanup(authenticate.stop)
+
+    @patch('weather_app.tasks.get_weather_async', new_callable=AsyncMock)
+    async def test_get_weather(self, mock_get_weather_async, mock_has_permission):
+        mock_get_weather_async.side_effect = lambda city_name: {'city': city_name}
+        response = await self.async_client.get(reverse('async_get_weather'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), [{'city': 'Moscow'}, {'city': 'Berlin'}])
+
+    @patch('weather_app.async_views.find_city_id_async', new_callable=AsyncMock, return_value=703448)
+    async def test_create_city(self, mock_find_city_id, mock_has_permission):
+        data = {'name': 'Kyiv'}
+        response = await self.async_client.post(reverse('async_cities'), data, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json(), {'name': 'Kyiv'})
+
+    @patch('weather_app.async_views.find_city_id_async', new_callable=AsyncMock)
+    async def test_create_added_city(self, mock_find_city_id, mock_has_permission):
+        data = {'name': 'Berlin'}
+        response = await self.async_client.post(reverse('async_cities'), data, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), 'City already added in your subscription')
+        mock_find_city_id.assert_not_called()
+
+    @patch('weather_app.async_views.weather_api_get_async', new_callable=AsyncMock)
+    async def test_create_city_while_provider_fails(self, mock_get, mock_has_permission):
+        mock_get.return_value = Mock(status_code=502)
+        data = {'name': 'Atlantis'}
+        response = await self.async_client.post(reverse('async_cities'), data, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIsNone(cache.get(city_id_key('Atlantis')))
+
+    async def test_method_not_allowed(self, mock_has_permission):
+        response = await self.async_client.delete(reverse('async_get_weather'))
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+class CityTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='test@test.com', password='test_password')
+        self.subscription = Subscription.objects.create(user=self.user, period_notifications=3)
+
+    def test_city_is_shared_by_normalized_name(self):
+        first = CityInSubscription.objects.create(subscription=self.subscription, name='New  York')
+        other_user = User.objects.create(email='other@test.com', password='test_password')
+        other_subscription = Subscription.objects.create(user=other_user, period_notifications=6)
+        second = CityInSubscription.objects.create(subscription=other_subscription, name='new york ')
+        self.assertEqual(first.city_id, second.city_id)
+        self.assertEqual(first.city.name, 'New York')
+
+    def test_provider_id_is_filled_in_once_known(self):
+        City.objects.get_for_name('Berlin')
+        city = City.objects.get_for_name('berlin', owm_id=2950159)
+        self.assertEqual(City.objects.get(id=city.id).owm_id, 2950159)
+        self.assertEqual(City.objects.count(), 1)
+
+    def test_provider_id_is_looked_up_before_name(self):
+        kyiv = City.objects.create(name='Kyiv', normalized_name='kyiv', owm_id=703448)
+        self.assertEqual(City.objects.get_for_name('Kiev', owm_id=703448), kyiv)
+        self.assertEqual(City.objects.count(), 1)
+
+    def test_city_is_unique_in_subscription(self):
+        CityInSubscription.objects.create(subscription=self.subscription, name='Berlin')
+        with self.assertRaises(IntegrityError):
+            CityInSubscription.objects.create(subscription=self.subscription, name='BERLIN')
+
+
+class AdminTestCase(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create(email='admin@test.com', is_staff=True, is_superuser=True)
+        self.client.force_login(self.admin)
+        for i in range(3):
+            user = User.objects.create(email=f'test_{i}@test.com', password='test_password')
+            subscription = Subscription.objects.create(user=user, period_notifications=3)
+            CityInSubscription.objects.create(subscription=subscription, name=f'City {i}')
+
+    def changelist(self, model, **params):
+        return self.client.get(reverse(f'admin:weather_app_{model}_changelist'), params)
+
+    def test_changelists_do_not_query_per_row(self):
+        for model in ('subscription', 'cityinsubscription', 'city', 'user'):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.changelist(model).status_code, 200)
+            count = len(queries)
+            User.objects.create(email=f'more_{model}@test.com', password='test_password')
+            if model in ('subscription', 'cityinsubscription'):
+                subscription = Subscription.objects.create(user=User.objects.last(), period_notifications=3)
+                CityInSubscription.objects.create(subscription=subscription, name=f'City {model}')
+            with self.assertNumQueries(count):
+                self.changelist(model)
+
+    def test_search_matches_indexed_columns_exactly(self):
+        response = self.changelist('cityinsubscription', q=' CITY 1')
+        self.assertEqual([city.name for city in response.context['cl'].result_list], ['City 1'])
+        response = self.changelist('subscription', q='test_2@test.com')
+        self.assertEqual([sub.user.email for sub in response.context['cl'].result_list], ['test_2@test.com'])
+        response = self.changelist('subscription', q='test_2')
+        self.assertEqual(len(response.context['cl'].result_list), 0)
+
+    @patch('weather_app.admin.estimate_count', return_value=5000000)
+    def test_large_tables_use_estimated_count(self, mock_estimate_count):
+        self.assertEqual(EstimatedCountPaginator(Subscription.objects.all(), 100).count, 5000000)
+        self.assertEqual(EstimatedCountPaginator(Subscription.objects.filter(period_notifications=3), 100).count, 3)
+        mock_estimate_count.return_value = 10
+        self.assertEqual(EstimatedCountPaginator(Subscription.objects.all(), 100).count, 3)
+
 
 class ViewTestCase(TestCase):
 
@@ -209,3 +594,1049 @@ class TaskTestCase(TestCase):
         sub_id = self.subscription_2.id
         send_email_task(sub_id)
         self.assertEqual(mock_get_weather.call_count, 0)
+
+
+class DispatchNotificationsTestCase(TestCase):
+
+    def setUp(self):
+        self.user_1 = User.objects.create(email='test_1@test.com', password='test_password')
+        self.user_2 = User.objects.create(email='test_2@test.com', password='test_password')
+        self.user_3 = User.objects.create(email='test_3@test.com', password='test_password')
+        self.subscription_1 = Subscription.objects.create(user=self.user_1, period_notifications=3)
+        self.subscription_2 = Subscription.objects.create(user=self.user_2, period_notifications=3)
+        self.subscription_3 = Subscription.objects.create(user=self.user_3, period_notifications=6)
+        CityInSubscription.objects.create(subscription=self.subscription_1, name='London')
+        CityInSubscription.objects.create(subscription=self.subscription_1, name='Berlin')
+        CityInSubscription.objects.create(subscription=self.subscription_2, name='london ')
+        CityInSubscription.objects.create(subscription=self.subscription_3, name='Paris')
+
+    @patch('weather_app.tasks.send_batch', return_value=[])
+    @patch('weather_app.tasks.get_weather')
+    def test_each_city_fetched_once_per_window(self, mock_get_weather, mock_send_batch):
+        mock_get_weather.side_effect = lambda city_name: {
+            'city': city_name, 'temperature': '1°C', 'feels like': '0°C', 'description': 'rain', 'wind speed': '1 m/s',
+        }
+        send_notifications(Subscription.objects.filter(id__in=[self.subscription_1.id, self.subscription_2.id]))
+        self.assertEqual(mock_get_weather.call_count, 2)
+        recipients = sorted(
+            notification.email for call in mock_send_batch.call_args_list for notification in call.args[1]
+        )
+        self.assertEqual(recipients, ['test_1@test.com', 'test_2@test.com'])
+
+    @patch('weather_app.tasks.send_batch', return_value=[])
+    @patch('weather_app.tasks.get_weather')
+    def test_failed_city_does_not_abort_window(self, mock_get_weather, mock_send_batch):
+        mock_get_weather.side_effect = KeyError('main')
+        send_notifications(Subscription.objects.filter(id=self.subscription_3.id))
+        self.assertEqual(mock_get_weather.call_count, 1)
+        mock_send_batch.assert_not_called()
+
+    @patch('weather_app.tasks.notification_pipeline')
+    @patch('weather_app.tasks.settings.NOTIFICATIONS_DISPATCH_BATCH_SIZE', 1)
+    def test_dispatcher_claims_due_subscriptions_in_batches(self, mock_pipeline):
+        now = timezone.now()
+        Subscription.objects.filter(id=self.subscription_1.id).update(next_due_at=now - timedelta(minutes=1))
+        Subscription.objects.filter(id=self.subscription_2.id).update(next_due_at=now - timedelta(hours=7))
+        Subscription.objects.filter(id=self.subscription_3.id).update(next_due_at=now + timedelta(minutes=1))
+        dispatch_due_notifications_task()
+        self.assertEqual(
+            [call.args[0] for call in mock_pipeline.call_args_list],
+            [[self.subscription_2.id], [self.subscription_1.id]],
+        )
+        self.assertEqual(mock_pipeline.return_value.delay.call_count, 2)
+        self.subscription_1.refresh_from_db()
+        self.subscription_2.refresh_from_db()
+        self.assertEqual(self.subscription_1.next_due_at, now - timedelta(minutes=1) + timedelta(hours=3))
+        self.assertGreater(self.subscription_2.next_due_at, now)
+
+    @patch('weather_app.tasks.send_batch', return_value=[])
+    @patch('weather_app.tasks.get_weather')
+    def test_pipeline_stages_pass_results_along(self, mock_get_weather, mock_send_batch):
+        mock_get_weather.side_effect = lambda city_name: {
+            'city': city_name, 'temperature': '1°C', 'feels like': '0°C', 'description': 'rain', 'wind speed': '1 m/s',
+        }
+        notification_pipeline([self.subscription_1.id, self.subscription_3.id], '2026101800').apply()
+        notifications = [notification for call in mock_send_batch.call_args_list for notification in call.args[1]]
+        recipients = sorted(notification.email for notification in notifications)
+        self.assertEqual(recipients, ['test_1@test.com', 'test_3@test.com'])
+        self.assertIn('<strong>Paris</strong>', notifications[-1].html_content)
+
+    def test_pipeline_stages_are_routed_to_own_queues(self):
+        router = celery_app.amqp.router
+        queues = [
+            router.route({}, task.name)['queue'].name
+            for task in (fetch_weather_task, render_notifications_task, drain_outbox_task)
+        ]
+        self.assertEqual(queues, ['fetch', 'render', 'send'])
+        self.assertTrue(celery_app.conf.task_ignore_result)
+
+    def test_task_helpers_update_next_due_at(self):
+        create_task(self.subscription_1)
+        self.subscription_1.refresh_from_db()
+        self.assertGreater(self.subscription_1.next_due_at, timezone.now() + timedelta(hours=2))
+        delete_task(self.subscription_1)
+        self.subscription_1.refresh_from_db()
+        self.assertIsNone(self.subscription_1.next_due_at)
+
+
+def rejecting(*statuses):
+    """Fakes a send that rejects every recipient with the next status, and accepts all once they run out."""
+    statuses = list(statuses)
+
+    def send(*args):
+        if not statuses:
+            return []
+        status_code = statuses.pop(0)
+        return [(recipient, status_code) for recipient in args[-1]]
+    return send
+
+
+@patch('weather_app.tasks.get_weather', side_effect=lambda city_name: {'city': city_name, 'temperature': '1°C'})
+class OutboxTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        weather_cache.local.clear()
+        self.user = User.objects.create(email='test_1@test.com', password='test_password')
+        self.subscription = Subscription.objects.create(user=self.user, period_notifications=3)
+        CityInSubscription.objects.create(subscription=self.subscription, name='London')
+
+    def make_due(self):
+        OutboxMessage.objects.update(available_at=timezone.now())
+
+    @patch('weather_app.tasks.send_batch', return_value=[])
+    def test_window_is_sent_once(self, mock_send_batch, mock_get_weather):
+        send_notifications(Subscription.objects.all(), window='2026101800')
+        send_notifications(Subscription.objects.all(), window='2026101800')
+        self.assertEqual(mock_send_batch.call_count, 1)
+        self.assertEqual(OutboxMessage.objects.get().status, OutboxMessage.Status.SENT)
+
+    @patch('weather_app.tasks.send_batch', return_value=[])
+    def test_only_own_messages_are_sent(self, mock_send_batch, mock_get_weather):
+        other = OutboxMessage.objects.create(
+            subscription=self.subscription, idempotency_key='other', email='test_1@test.com', html_content='<p>',
+        )
+        send_notifications(Subscription.objects.all(), window='2026101800')
+        [notification] = mock_send_batch.call_args.args[1]
+        self.assertIn('London', notification.html_content)
+        self.assertEqual(OutboxMessage.objects.get(id=other.id).status, OutboxMessage.Status.PENDING)
+
+    @patch('weather_app.tasks.send_batch', side_effect=rejecting(None))
+    def test_retry_resends_stored_payload(self, mock_send_batch, mock_get_weather):
+        send_notifications(Subscription.objects.all(), window='2026101800')
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.status, OutboxMessage.Status.PENDING)
+        self.assertGreater(message.available_at, timezone.now())
+        self.make_due()
+        drain_outbox_task()
+        self.assertEqual(mock_get_weather.call_count, 1)
+        self.assertEqual(mock_send_batch.call_args_list[0], mock_send_batch.call_args_list[1])
+        self.assertEqual(OutboxMessage.objects.get().status, OutboxMessage.Status.SENT)
+
+    @patch('weather_app.tasks.send_batch', side_effect=rejecting(400))
+    def test_rejected_recipient_is_not_retried(self, mock_send_batch, mock_get_weather):
+        send_notifications(Subscription.objects.all(), window='2026101800')
+        self.assertEqual(OutboxMessage.objects.get().status, OutboxMessage.Status.FAILED)
+
+    @patch('weather_app.tasks.settings.OUTBOX_MAX_ATTEMPTS', 2)
+    @patch('weather_app.tasks.send_batch', side_effect=rejecting(503, 503))
+    def test_gives_up_after_max_attempts(self, mock_send_batch, mock_get_weather):
+        send_notifications(Subscription.objects.all(), window='2026101800')
+        self.make_due()
+        drain_outbox_task()
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.status, message.attempts), (OutboxMessage.Status.FAILED, 2))
+
+    @patch('weather_app.tasks.send_batch', side_effect=[[], RuntimeError('worker lost')])
+    def test_each_request_is_settled_when_it_returns(self, mock_send_batch, mock_get_weather):
+        for i in range(2):
+            OutboxMessage.objects.create(
+                subscription=self.subscription, idempotency_key=str(i), email='test_1@test.com', html_content=f'<p>{i}',
+            )
+        with self.assertRaises(RuntimeError):
+            drain_outbox_task()
+        sent = mock_send_batch.call_args_list[0].args[1]
+        self.assertEqual(OutboxMessage.objects.get(status=OutboxMessage.Status.SENT), sent[0])
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxMessage.Status.PENDING).count(), 1)
+
+    @patch('weather_app.tasks.send_batch')
+    def test_failures_are_matched_by_message(self, mock_send_batch, mock_get_weather):
+        other = Subscription.objects.create(
+            user=User.objects.create(email='test_2@test.com', password='test_password'), period_notifications=3,
+        )
+        messages = [
+            OutboxMessage.objects.create(
+                subscription=subscription, idempotency_key=str(subscription.id), email='shared@test.com',
+                html_content='<p>',
+            )
+            for subscription in (self.subscription, other)
+        ]
+        mock_send_batch.side_effect = lambda html_content, claimed: [
+            (message, 400) for message in claimed if message == messages[0]
+        ]
+        drain_outbox_task()
+        statuses = [OutboxMessage.objects.get(id=message.id).status for message in messages]
+        self.assertEqual(statuses, [OutboxMessage.Status.FAILED, OutboxMessage.Status.SENT])
+
+    @patch('weather_app.tasks.send_batch', return_value=[])
+    def test_claimed_batch_is_hidden_from_other_senders(self, mock_send_batch, mock_get_weather):
+        message = OutboxMessage.objects.create(
+            subscription=self.subscription, idempotency_key='1:2026101800', email='test_1@test.com', html_content='<p>',
+        )
+        self.assertEqual(claim_outbox(timezone.now(), 10, 60), [message])
+        self.assertEqual(claim_outbox(timezone.now(), 10, 60), [])
+        self.assertEqual(claim_outbox(timezone.now() + timedelta(seconds=61), 10, 60), [message])
+
+    @patch('weather_app.tasks.settings.OUTBOX_BATCH_SIZE', 1)
+    @patch('weather_app.tasks.drain_outbox_task.delay')
+    @patch('weather_app.tasks.send_batch', return_value=[])
+    def test_full_batch_queues_next_drain(self, mock_send_batch, mock_delay, mock_get_weather):
+        for i in range(2):
+            OutboxMessage.objects.create(
+                subscription=self.subscription, idempotency_key=str(i), email='test_1@test.com', html_content='<p>',
+            )
+        drain_outbox_task()
+        self.assertEqual(mock_delay.call_count, 1)
+        self.assertEqual(len(mock_send_batch.call_args.args[1]), 1)
+
+
+class WeatherCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        weather_cache.local.clear()
+        self.weather_cache = WeatherCache(ttl=60, max_size=2)
+
+    def test_lru_eviction(self):
+        lru = LRUCache(max_size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(len(lru), 2)
+
+    def test_key_is_normalized(self):
+        self.weather_cache.set(' London ', {'city': 'London'})
+        self.assertEqual(self.weather_cache.get_entry('london')['data'], {'city': 'London'})
+
+    def test_hits_and_misses(self):
+        self.assertIsNone(self.weather_cache.get_entry('Berlin'))
+        self.weather_cache.set('Berlin', {'city': 'Berlin'})
+        self.weather_cache.get_entry('Berlin')
+        self.weather_cache.local.clear()
+        self.weather_cache.get_entry('Berlin')
+        stats = self.weather_cache.stats()
+        self.assertEqual(stats['process']['misses'], 1)
+        self.assertEqual(stats['process']['local_hits'], 1)
+        self.assertEqual(stats['process']['shared_hits'], 1)
+        self.assertEqual(stats['cluster']['misses'], 1)
+
+    @patch('weather_app.cache.time.time')
+    def test_expired_entry_is_stale(self, mock_time):
+        mock_time.return_value = 1000
+        self.weather_cache.set('Kyiv', {'city': 'Kyiv'})
+        mock_time.return_value = 1061
+        entry = self.weather_cache.get_entry('Kyiv')
+        self.assertFalse(self.weather_cache.is_fresh(entry))
+        self.assertEqual(self.weather_cache.reading(entry), {'city': 'Kyiv', 'stale': True, 'age': 61})
+
+    @patch('weather_app.tasks.fetch_weather')
+    def test_get_weather_goes_through_cache(self, mock_fetch_weather):
+        mock_fetch_weather.return_value = {'city': 'Paris'}
+        get_weather('Paris')
+        get_weather('paris')
+        self.assertEqual(mock_fetch_weather.call_count, 1)
+
+
+def group_response(url, id, units):
+    return Mock(status_code=200, json=Mock(return_value={'list': [
+        {
+            'id': int(owm_id), 'name': f'City {owm_id}', 'main': {'temp': 1, 'feels_like': 0},
+            'weather': [{'description': 'rain'}], 'wind': {'speed': 2},
+        }
+        for owm_id in id.split(',')
+    ]}))
+
+
+class GroupWeatherTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        weather_cache.local.clear()
+        self.cities = [City.objects.create(name=f'City {i}', normalized_name=f'city {i}', owm_id=i) for i in range(25)]
+
+    @patch('weather_app.tasks.weather_api_get', side_effect=group_response)
+    def test_cities_are_fetched_in_chunks(self, mock_weather_api_get):
+        weather_by_city = get_weather_many(self.cities)
+        self.assertEqual(mock_weather_api_get.call_count, 2)
+        self.assertEqual(len(mock_weather_api_get.call_args_list[0].kwargs['id'].split(',')), 20)
+        self.assertEqual(weather_by_city['city 7']['city'], 'City 7')
+        self.assertEqual(len(weather_by_city), 25)
+
+    @patch('weather_app.tasks.weather_api_get', side_effect=group_response)
+    def test_group_results_are_cached(self, mock_weather_api_get):
+        get_weather_many(self.cities[:3])
+        get_weather_many(self.cities[:5])
+        self.assertEqual(mock_weather_api_get.call_count, 2)
+        self.assertEqual(mock_weather_api_get.call_args.kwargs['id'], '3,4')
+
+    @patch('weather_app.tasks.get_weather')
+    @patch('weather_app.tasks.weather_api_get', side_effect=group_response)
+    def test_cities_without_provider_id_are_fetched_by_name(self, mock_weather_api_get, mock_get_weather):
+        city = City.objects.create(name='Atlantis', normalized_name='atlantis')
+        get_weather_many([self.cities[0], city])
+        self.assertEqual(mock_weather_api_get.call_count, 1)
+        mock_get_weather.assert_called_once_with('Atlantis')
+
+
+class CacheWarmingTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        weather_cache.local.clear()
+        now = timezone.now()
+        self.cities = [City.objects.create(name=f'City {i}', normalized_name=f'city {i}', owm_id=i) for i in range(45)]
+        for i, due_in in enumerate([timedelta(minutes=4, seconds=30), timedelta(minutes=30)]):
+            user = User.objects.create(email=f'test_{i}@test.com', password='test_password')
+            subscription = Subscription.objects.create(user=user, period_notifications=3, next_due_at=now + due_in)
+            for city in self.cities[i::2]:
+                CityInSubscription.objects.create(subscription=subscription, city=city, name=city.name)
+
+    @patch('weather_app.tasks.warm_cities_task.apply_async')
+    def test_cities_due_within_lead_time_are_queued_paced(self, mock_apply_async):
+        weather_cache.set('City 0', {'city': 'City 0'})
+        warm_weather_cache_task()
+        batches = [call.args[0][0] for call in mock_apply_async.call_args_list]
+        self.assertEqual(sorted(sum(batches, [])), sorted(city.id for city in self.cities[2::2]))
+        self.assertEqual([len(batch) for batch in batches], [20, 2])
+        self.assertEqual([call.kwargs['countdown'] for call in mock_apply_async.call_args_list], [0, 2])
+
+    @patch('weather_app.tasks.warm_cities_task.apply_async')
+    def test_many_batches_stay_within_quota_share(self, mock_apply_async):
+        with self.settings(OPEN_WEATHER_GROUP_LIMIT=1, OPEN_WEATHER_CALLS_PER_MINUTE=20):
+            warm_weather_cache_task()
+        countdowns = [call.kwargs['countdown'] for call in mock_apply_async.call_args_list]
+        self.assertEqual(countdowns, [i * 6 for i in range(10)])
+        self.assertLess(countdowns[-1], settings.WEATHER_WARMING_INTERVAL)
+
+    @patch('weather_app.tasks.weather_api_get', side_effect=group_response)
+    def test_warmed_cities_are_cache_hits(self, mock_weather_api_get):
+        warm_cities_task([city.id for city in self.cities[:20]])
+        self.assertEqual(mock_weather_api_get.call_count, 1)
+        get_weather_many(self.cities[:20])
+        self.assertEqual(mock_weather_api_get.call_count, 1)
+
+
+CITY_LIST = [
+    {'id': 2643743, 'name': 'London', 'country': 'GB'},
+    {'id': 6058560, 'name': 'London', 'country': 'CA'},
+    {'id': 2950159, 'name': 'Berlin', 'country': 'DE'},
+    {'id': 703448, 'name': 'Kyiv', 'country': 'UA'},
+    {'id': 5128581, 'name': 'New York City', 'country': 'US'},
+]
+
+
+class CityCatalogTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'catalog', 'city_catalog.tsv')
+        write_catalog(read_city_list(gzip.compress(json.dumps(CITY_LIST).encode())), self.path)
+        self.catalog = CityCatalog(self.path)
+        catalog = patch('weather_app.catalog.city_catalog', self.catalog)
+        catalog.start()
+        self.addCleanup(catalog.stop)
+
+    def test_lookup(self):
+        self.assertEqual(len(self.catalog), 5)
+        self.assertEqual(self.catalog.lookup(' new york  city').name, 'New York City')
+        self.assertEqual(self.catalog.lookup('berlin').id, 2950159)
+        self.assertIsNone(self.catalog.lookup('Atlantis'))
+
+    @patch('weather_app.catalog.fetch_city_id', return_value=2643743)
+    def test_shared_name_is_resolved_by_provider(self, mock_fetch_city_id):
+        self.assertIsNone(self.catalog.lookup('London'))
+        self.assertEqual(find_city_id('London'), 2643743)
+        self.assertEqual(find_city_ids(['london']), {'london': 2643743})
+        self.assertEqual(mock_fetch_city_id.call_count, 1)
+
+    def test_search_prefix(self):
+        self.assertEqual(
+            [(city.name, city.country) for city in self.catalog.search('LON', 10)],
+            [('London', 'GB'), ('London', 'CA')],
+        )
+        self.assertEqual(len(self.catalog.search('l', 1)), 1)
+        self.assertEqual(self.catalog.search('  ', 10), [])
+        self.assertEqual(self.catalog.search('x', 10), [])
+
+    @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+    def test_search_endpoint(self, mock_has_permission):
+        user = User.objects.create(email='test@test.com', password='test_password')
+        client = APIClient()
+        client.force_authenticate(user)
+        with patch('weather_app.views.city_catalog', self.catalog):
+            response = client.get(reverse('city_search'), {'q': 'ber'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [{'id': 2950159, 'name': 'Berlin', 'country': 'DE'}])
+
+    def test_missing_catalog_is_empty(self):
+        self.assertIsNone(CityCatalog(self.path + '.missing').lookup('London'))
+
+    @patch('weather_app.catalog.fetch_city_id')
+    def test_known_city_is_resolved_locally(self, mock_fetch_city_id):
+        self.assertEqual(find_city_id('Kyiv'), 703448)
+        mock_fetch_city_id.assert_not_called()
+
+    @patch('weather_app.catalog.weather_api_get')
+    def test_only_not_found_is_remembered(self, mock_get):
+        mock_get.return_value = Mock(status_code=502)
+        with self.assertRaises(CityLookupUnavailable):
+            find_city_id('Atlantis')
+        with self.assertRaises(CityLookupUnavailable):
+            find_city_ids(['Atlantis'])
+        self.assertIsNone(cache.get(city_id_key('Atlantis')))
+        mock_get.return_value = Mock(status_code=404)
+        self.assertIsNone(find_city_id('Atlantis'))
+        self.assertEqual(cache.get(city_id_key('Atlantis')), 0)
+
+    @patch('weather_app.views.find_city_id', side_effect=CityLookupUnavailable())
+    @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+    def test_create_city_while_provider_fails(self, mock_has_permission, mock_find_city_id):
+        client = APIClient()
+        client.force_authenticate(User.objects.create(email='test@test.com', password='test_password'))
+        Subscription.objects.create(user=User.objects.get(), period_notifications=3)
+        response = client.post(reverse('cities'), data={'name': 'Atlantis'})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    @patch('weather_app.catalog.fetch_city_id', return_value=None)
+    def test_unknown_city_is_looked_up_once(self, mock_fetch_city_id):
+        self.assertIsNone(find_city_id('Atlantis'))
+        self.assertIsNone(find_city_id('atlantis'))
+        mock_fetch_city_id.assert_called_once_with('Atlantis')
+
+
+class WeatherApiClientTestCase(TestCase):
+
+    def test_session_is_shared_and_pooled(self):
+        session = get_session()
+        self.assertIs(get_session(), session)
+        adapter = session.get_adapter('http://api.openweathermap.org')
+        self.assertEqual(adapter.max_retries.total, 0)
+
+    @patch('weather_app.client.time.sleep')
+    @patch('weather_app.client.upstream_limiter')
+    @patch('weather_app.client.requests.Session.get')
+    def test_every_retry_takes_an_upstream_token(self, mock_get, mock_limiter, mock_sleep):
+        mock_get.side_effect = [Mock(status_code=429), Mock(status_code=503), Mock(status_code=200)]
+        response = weather_api_get('http://weather.test/weather', q='London')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(mock_limiter.acquire.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch('weather_app.client.requests.Session.get')
+    def test_requests_have_timeouts(self, mock_get):
+        mock_get.return_value.status_code = 200
+        weather_api_get('http://weather.test/weather', q='London')
+        self.assertEqual(mock_get.call_args.kwargs['timeout'], (3.05, 10.0))
+        self.assertEqual(mock_get.call_args.kwargs['params']['q'], 'London')
+
+    @patch('weather_app.client.asyncio.sleep', new_callable=AsyncMock)
+    async def test_async_requests_are_retried(self, mock_sleep):
+        client = get_async_client()
+        responses = [AsyncMock(status_code=503), AsyncMock(status_code=200)]
+        with patch.object(client, 'get', new_callable=AsyncMock, side_effect=responses) as mock_get:
+            response = await weather_api_get_async('http://weather.test/weather', q='London')
+        await close_async_client()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_get.call_count, 2)
+        mock_sleep.assert_awaited_once()
+
+    async def test_async_client_is_shared_on_the_loop(self):
+        client = get_async_client()
+        self.assertIs(get_async_client(), client)
+        await close_async_client()
+        self.assertTrue(client.is_closed)
+        self.assertIsNot(get_async_client(), client)
+        await close_async_client()
+
+    async def test_async_client_is_closed_at_lifespan_shutdown(self):
+        from WeatherReminder.asgi import application
+
+        client = get_async_client()
+        communicator = ApplicationCommunicator(application, {'type': 'lifespan'})
+        await communicator.send_input({'type': 'lifespan.startup'})
+        self.assertEqual(await communicator.receive_output(5), {'type': 'lifespan.startup.complete'})
+        await communicator.send_input({'type': 'lifespan.shutdown'})
+        self.assertEqual(await communicator.receive_output(5), {'type': 'lifespan.shutdown.complete'})
+        self.assertTrue(client.is_closed)
+
+    @patch('weather_app.client.breaker', CircuitBreaker(failure_threshold=1, reset_timeout=30))
+    async def test_closed_async_client_is_a_transport_error(self):
+        client = get_async_client()
+        with patch.object(client, 'get', new_callable=AsyncMock, side_effect=RuntimeError('client closed')):
+            with self.assertRaises(RuntimeError):
+                await weather_api_get_async('http://weather.test/weather', q='London')
+        await close_async_client()
+        with self.assertRaises(CircuitOpen):
+            await weather_api_get_async('http://weather.test/weather', q='London')
+
+
+class RateLimitTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_local_bucket_borrows_within_max_wait(self):
+        bucket = LocalTokenBucket(rate=1, capacity=2)
+        self.assertEqual(bucket.reserve(max_wait=0), (True, 0.0))
+        self.assertEqual(bucket.reserve(max_wait=0), (True, 0.0))
+        granted, wait = bucket.reserve(max_wait=0)
+        self.assertFalse(granted)
+        self.assertAlmostEqual(wait, 1, places=2)
+        granted, wait = bucket.reserve(max_wait=2)
+        self.assertTrue(granted)
+        self.assertAlmostEqual(wait, 1, places=2)
+
+    @patch('weather_app.ratelimit.settings.OPEN_WEATHER_RATE_LIMIT_MAX_WAIT', 0)
+    @patch('weather_app.ratelimit.settings.OPEN_WEATHER_BURST', 2)
+    def test_limiter_counts_calls_and_rejects_when_empty(self):
+        limiter = UpstreamLimiter()
+        limiter.acquire()
+        limiter.acquire()
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire()
+        usage = limiter.usage()
+        self.assertEqual(usage['minute'], {'used': 2, 'quota': 60})
+        self.assertEqual(usage['day']['used'], 2)
+
+    @patch('weather_app.tasks.get_weather_many', side_effect=RateLimitExceeded(5))
+    def test_fetch_task_is_requeued_when_bucket_is_empty(self, mock_get_weather_many):
+        with patch.object(fetch_weather_task, 'retry', return_value=Retry()) as mock_retry:
+            with self.assertRaises(Retry):
+                fetch_weather_task([1])
+        mock_retry.assert_called_once_with(countdown=5, max_retries=None)
+
+    @patch('weather_app.tasks.fetch_batch', side_effect=RateLimitExceeded(5))
+    def test_get_weather_marks_rate_limited_cities(self, mock_fetch_batch):
+        result = get_weather_concurrently([City(name='London', normalized_name='london')], timeout=1)
+        self.assertEqual(result, [{'city': 'London', 'error': 'rate_limited'}])
+
+    @patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+    def test_quota_stats_for_staff_only(self, mock_has_permission):
+        user = User.objects.create(email='test@test.com', password='test_password')
+        self.client.force_authenticate(user)
+        url = reverse('upstream_quota_stats')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+        user.is_staff = True
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['day'], {'used': 0, 'quota': 32000})
+
+
+class ResilienceTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        weather_cache.local.clear()
+        self.reading = {
+            'city': 'Oslo', 'temperature': '1°C', 'feels like': '0°C', 'description': 'snow', 'wind speed': '4 m/s',
+        }
+
+    def store_stale(self, city_name, age):
+        with patch('weather_app.cache.time.time', return_value=time.time() - age):
+            weather_cache.set(city_name, self.reading)
+
+    @patch('weather_app.tasks.refresh_in_background')
+    @patch('weather_app.tasks.fetch_weather')
+    def test_stale_reading_is_served_while_refreshing(self, mock_fetch_weather, mock_refresh):
+        self.store_stale('Oslo', 900)
+        data = get_weather('Oslo')
+        self.assertTrue(data['stale'])
+        self.assertGreaterEqual(data['age'], 900)
+        self.assertEqual(data['temperature'], '1°C')
+        mock_fetch_weather.assert_not_called()
+        self.assertEqual([city.name for city in mock_refresh.call_args.args[0]], ['Oslo'])
+
+    @patch('weather_app.tasks.fetch_weather_group', side_effect=WeatherApiError('OpenWeather answered 502'))
+    def test_notifications_fall_back_to_stale_reading(self, mock_fetch_weather_group):
+        self.store_stale('Oslo', 900)
+        weather_by_city = get_weather_many([City(name='Oslo', normalized_name='oslo', owm_id=3143244)])
+        self.assertTrue(weather_by_city['oslo']['stale'])
+        mock_fetch_weather_group.assert_called_once_with([3143244])
+
+    @patch('weather_app.tasks.fetch_executor.submit')
+    def test_no_fetch_is_started_after_the_deadline(self, mock_submit):
+        self.store_stale('Oslo', 900)
+        cities = [
+            City(name='Oslo', normalized_name='oslo', owm_id=3143244), City(name='Bergen', normalized_name='bergen'),
+        ]
+        weather = list(iter_weather(cities, timeout=0, chunk_size=1))
+        self.assertEqual(weather[0]['temperature'], '1°C')
+        self.assertEqual(weather[1], {'city': 'Bergen', 'error': 'timeout'})
+        mock_submit.assert_not_called()
+
+    @patch('weather_app.tasks.fetch_executor.submit')
+    def test_background_refresh_is_claimed_once_across_processes(self, mock_submit):
+        oslo = City(name='Oslo', normalized_name='oslo', owm_id=3143244)
+        refresh_in_background([oslo])
+        refresh_in_background([oslo])
+        self.assertEqual(mock_submit.call_count, 1)
+
+    def test_concurrent_refreshes_share_one_request(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def fetch(city_name):
+            calls.append(city_name)
+            started.set()
+            release.wait(5)
+            return self.reading
+
+        with patch('weather_app.tasks.fetch_weather', side_effect=fetch):
+            first = fetch_executor.submit(get_weather, 'Oslo')
+            started.wait(5)
+            second = fetch_executor.submit(get_weather, ' oslo')
+            time.sleep(0.05)
+            release.set()
+            self.assertEqual(first.result(5), self.reading)
+            self.assertEqual(second.result(5), self.reading)
+        self.assertEqual(calls, ['Oslo'])
+
+    @patch('weather_app.tasks.weather_api_get')
+    def test_error_response_is_an_upstream_error(self, mock_get):
+        mock_get.return_value = Mock(status_code=401, json=Mock(return_value={'cod': 401, 'message': 'Invalid key'}))
+        with self.assertRaises(WeatherApiError):
+            fetch_weather('Oslo')
+
+    @patch('weather_app.client.time.monotonic')
+    def test_circuit_breaker_opens_and_probes(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record(success=False)
+        breaker.before_call()
+        breaker.record(success=False)
+        with self.assertRaises(CircuitOpen):
+            breaker.before_call()
+        mock_monotonic.return_value = 131
+        breaker.before_call()
+        with self.assertRaises(CircuitOpen):
+            breaker.before_call()
+        breaker.record(success=True)
+        breaker.before_call()
+
+    @patch('weather_app.client.time.sleep')
+    @patch('weather_app.client.get_session')
+    @patch('weather_app.client.breaker', CircuitBreaker(failure_threshold=1, reset_timeout=30))
+    def test_open_circuit_skips_upstream_calls(self, mock_get_session, mock_sleep):
+        mock_get_session.return_value.get.return_value = Mock(status_code=503)
+        weather_api_get('http://weather.test/weather', q='Oslo')
+        calls = mock_get_session.return_value.get.call_count
+        with self.assertRaises(CircuitOpen):
+            weather_api_get('http://weather.test/weather', q='Oslo')
+        self.assertEqual(calls, 4)
+        self.assertEqual(mock_get_session.return_value.get.call_count, calls)
+
+
+class BulkMailTestCase(TestCase):
+
+    def setUp(self):
+        client = patch('weather_app.mail._client', None)
+        client.start()
+        self.addCleanup(client.stop)
+
+    def send(self, notifications):
+        return [failed for batch in content_batches(notifications) for failed in send_batch(*batch)]
+
+    def test_recipients_share_requests_by_body(self):
+        notifications = [
+            Notification('test_1@test.com', '<p>London</p>'),
+            Notification('test_2@test.com', '<p>London</p>'),
+            Notification('test_3@test.com', '<p>Berlin</p>'),
+        ]
+        with sendgrid_stub() as stub, self.settings(SENDGRID_API_HOST=stub.url):
+            failed = self.send(notifications)
+        self.assertEqual(failed, [])
+        self.assertEqual(len(stub.requests), 2)
+        self.assertEqual(len(stub.requests[0]['personalizations']), 2)
+
+    def test_rejected_recipients_are_reported(self):
+        notifications = [Notification(f'test_{i}@test.com', '<p>London</p>') for i in range(4)]
+        with sendgrid_stub(reject=['test_2@test.com']) as stub, self.settings(SENDGRID_API_HOST=stub.url):
+            failed = self.send(notifications)
+        self.assertEqual(failed, [(notifications[2], 400)])
+
+    @patch('weather_app.mail.SendGridAPIClient')
+    def test_message_errors_fail_the_batch_at_once(self, mock_client):
+        notifications = [Notification(f'test_{i}@test.com', '<p>London</p>') for i in range(4)]
+        body = json.dumps({'errors': [{'message': 'The from address is not verified', 'field': 'from.email'}]})
+        mock_client.return_value.send.side_effect = HTTPError(400, 'Bad Request', body, {})
+        failed = send_batch('<p>London</p>', notifications)
+        self.assertEqual(failed, [(notification, 400) for notification in notifications])
+        self.assertEqual(mock_client.return_value.send.call_count, 1)
+
+    @patch('weather_app.mail.SendGridAPIClient')
+    def test_transport_errors_are_transient_failures(self, mock_client):
+        notifications = [Notification('test_1@test.com', '<p>London</p>'), Notification('test_2@test.com', '<p>')]
+        mock_client.return_value.send.side_effect = [ConnectionResetError(), RemoteDisconnected()]
+        self.assertEqual(self.send(notifications), [(notifications[0], None), (notifications[1], None)])
+
+    def test_client_times_out_within_outbox_lease(self):
+        timeout = get_sendgrid_client().client.timeout
+        self.assertEqual(timeout, settings.SENDGRID_TIMEOUT)
+        self.assertLess(timeout, settings.OUTBOX_LEASE)
+
+    @patch('weather_app.mail.SendGridAPIClient')
+    def test_requests_are_limited_and_client_reused(self, mock_client):
+        notifications = [Notification(f'test_{i}@test.com', '<p>London</p>') for i in range(5)]
+        with self.settings(SENDGRID_PERSONALIZATIONS_LIMIT=2):
+            self.send(notifications)
+        self.assertEqual(mock_client.call_count, 1)
+        self.assertEqual(mock_client.return_value.send.call_count, 3)
+
+
+class LoadBenchmarkTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        weather_cache.local.clear()
+        client = patch('weather_app.mail._client', None)
+        client.start()
+        self.addCleanup(client.stop)
+
+    def test_openweather_stub_answers_group_requests(self):
+        with openweather_stub() as stub, self.settings(OPEN_WEATHER_GROUP_API_URL=f'{stub.url}/data/2.5/group'):
+            readings = fetch_weather_group([1, 2])
+        self.assertEqual(set(readings), {1, 2})
+        self.assertEqual(len(stub.requests), 1)
+
+    def test_openweather_stub_injects_errors(self):
+        with openweather_stub(error_rate=1, error_status=401) as stub, \
+                self.settings(OPEN_WEATHER_GROUP_API_URL=f'{stub.url}/data/2.5/group'):
+            with self.assertRaises(WeatherApiError):
+                fetch_weather_group([1])
+
+    def test_benchmark_writes_report(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'report.json')
+            call_command(
+                'benchmark_load', subscriptions=4, cities_per_subscription=2, city_pool=3, requests=0,
+                openweather_latency=0, sendgrid_latency=0, output=output, stdout=open(os.devnull, 'w'),
+            )
+            with open(output) as f:
+                report = json.load(f)
+        self.assertEqual(report['dispatch']['emails_sent'], 4)
+        self.assertEqual(report['dispatch']['upstream_calls'], 1)
+        self.assertFalse(User.objects.filter(email__endswith='@benchmark.invalid').exists())
+
+    @patch('weather_app.management.commands.benchmark_load.benchmark_endpoint', return_value={'requests': 0})
+    def test_benchmark_deletes_only_its_own_api_key(self, mock_benchmark_endpoint):
+        operator_key, _ = APIKey.objects.create_key(name='benchmark')
+        call_command(
+            'benchmark_load', subscriptions=2, cities_per_subscription=1, city_pool=2, requests=1,
+            openweather_latency=0, sendgrid_latency=0, stdout=open(os.devnull, 'w'),
+        )
+        self.assertTrue(mock_benchmark_endpoint.called)
+        self.assertEqual(list(APIKey.objects.all()), [operator_key])
+
+
+class APIKeyCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        verified_keys.local.clear()
+        self.api_key, self.key = APIKey.objects.create_key(name='test')
+
+    @patch('rest_framework_api_key.crypto.check_password', return_value=True)
+    def test_verified_key_skips_hasher(self, mock_check_password):
+        self.assertTrue(CachedAPIKey.objects.is_valid(self.key))
+        self.assertTrue(CachedAPIKey.objects.is_valid(self.key))
+        self.assertEqual(mock_check_password.call_count, 1)
+
+    def test_revoked_key_is_rejected_at_once(self):
+        self.assertTrue(CachedAPIKey.objects.is_valid(self.key))
+        self.api_key.revoked = True
+        self.api_key.save()
+        self.assertFalse(CachedAPIKey.objects.is_valid(self.key))
+
+    def test_other_processes_drop_verified_keys(self):
+        self.assertTrue(CachedAPIKey.objects.is_valid(self.key))
+        with patch.object(verified_keys, 'local', LRUCache(10)):
+            APIKey.objects.filter(pk=self.api_key.pk).delete()
+        self.assertFalse(CachedAPIKey.objects.is_valid(self.key))
+
+    def test_wrong_key_is_rejected(self):
+        self.assertFalse(CachedAPIKey.objects.is_valid(f'{self.api_key.prefix}.wrong'))
+
+
+class CachedJWTAuthenticationTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(email='test@test.com', password='test_password')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        patcher = patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def subscribe(self):
+        subscription = Subscription.objects.create(user=self.user, period_notifications=3)
+        return CityInSubscription.objects.create(subscription=subscription, name='London')
+
+    def test_repeated_requests_only_load_returned_data(self):
+        city = self.subscribe()
+        self.client.get(reverse('one_city', args=[city.pk]))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('one_city', args=[city.pk]))
+        self.assertEqual(response.data, {'name': 'London'})
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get(reverse('cities'))
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(reverse('cities'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_new_subscription_is_resolved(self):
+        self.client.get(reverse('one_city', args=[1]))
+        city = self.subscribe()
+        response = self.client.get(reverse('one_city', args=[city.pk]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ConditionalGetTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(email='test@test.com', password='test_password')
+        subscription = Subscription.objects.create(user=self.user, period_notifications=3)
+        self.city = CityInSubscription.objects.create(subscription=subscription, name='London')
+        self.client.force_authenticate(self.user)
+        patcher = patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unchanged_read_costs_no_queries(self):
+        etag = self.client.get(reverse('subscription'))['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('subscription'), HTTP_IF_NONE_MATCH=etag)
+            cached = self.client.get(reverse('subscription'))
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(cached.data['period_notifications'], 3)
+
+    def test_change_within_one_second_is_served(self):
+        last_modified = self.client.get(reverse('cities'))['Last-Modified']
+        CityInSubscription.objects.create(subscription=self.city.subscription, name='Berlin')
+        response = self.client.get(reverse('cities'), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_change_outside_the_api_is_served(self):
+        etag = self.client.get(reverse('subscription'))['ETag']
+        Subscription.objects.get(user=self.user).save()
+        response = self.client.get(reverse('subscription'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_subscription_change_is_served(self):
+        etag = self.client.get(reverse('subscription'))['ETag']
+        self.client.put(reverse('subscription'), data={'period_notifications': 6})
+        response = self.client.get(reverse('subscription'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['period_notifications'], 6)
+
+    def test_removed_city_is_served(self):
+        etag = self.client.get(reverse('cities'))['ETag']
+        self.client.delete(reverse('one_city', args=[self.city.pk]))
+        response = self.client.get(reverse('cities'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.data['results'], [])
+
+    def test_city_removed_outside_the_api_is_served(self):
+        etag = self.client.get(reverse('cities'))['ETag']
+        CityInSubscription.objects.filter(id=self.city.id).delete()
+        response = self.client.get(reverse('cities'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.data['results'], [])
+
+
+class EmailRenderingTestCase(TestCase):
+
+    def setUp(self):
+        fragment_cache.clear()
+        self.weather_by_city = {
+            'london': {
+                'city': 'London', 'temperature': '11°C', 'feels like': '9°C',
+                'description': 'light rain', 'wind speed': '3 m/s',
+            },
+            'berlin': {
+                'city': 'Berlin', 'temperature': '8°C', 'feels like': '5°C',
+                'description': 'clear sky', 'wind speed': '2 m/s',
+            },
+        }
+        self.london = City(name='London', normalized_name='london')
+        self.berlin = City(name='Berlin', normalized_name='berlin')
+        self.atlantis = City(name='Atlantis', normalized_name='atlantis')
+
+    def test_notification_is_joined_from_fragments(self):
+        fragments = render_fragments(self.weather_by_city)
+        html_content = render_notification([self.london, self.atlantis, self.berlin], fragments)
+        self.assertEqual(html_content, fragments['london'] + fragments['berlin'])
+        self.assertIn('<strong>London</strong>', html_content)
+        self.assertIn('Feels like 9°C', html_content)
+
+    @patch('weather_app.mail.get_fragment_template')
+    def test_fragment_is_rendered_once_per_snapshot(self, mock_get_template):
+        mock_get_template.return_value.render.return_value = '<p></p>'
+        render_fragments(self.weather_by_city)
+        render_fragments(self.weather_by_city)
+        self.assertEqual(mock_get_template.return_value.render.call_count, 2)
+        self.weather_by_city['london']['temperature'] = '12°C'
+        render_fragments(self.weather_by_city)
+        self.assertEqual(mock_get_template.return_value.render.call_count, 3)
+
+    def test_stale_fragment_is_reused_while_its_age_in_minutes_holds(self):
+        london = dict(self.weather_by_city['london'], stale=True, age=900)
+        fragment = render_fragments({'london': london})['london']
+        self.assertIn('Last updated 15 min ago', fragment)
+        self.assertIs(render_fragments({'london': dict(london, age=910)})['london'], fragment)
+        self.assertIn('Last updated 16 min ago', render_fragments({'london': dict(london, age=960)})['london'])
+
+
+class QueryBudgetTestCase(APITestCase):
+    """Every path must run a fixed number of queries, whatever the size of the data it touches."""
+
+    sizes = (1, 25)
+
+    def setUp(self):
+        self.user = User.objects.create(email='test@test.com', password='test_password')
+        self.subscription = Subscription.objects.create(user=self.user, period_notifications=3)
+        self.client.force_authenticate(self.user)
+        patcher = patch('rest_framework_api_key.permissions.HasAPIKey.has_permission')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertQueryBudget(self, budget, run, setup=None):
+        counts = []
+        for size in self.sizes:
+            if setup:
+                setup(size)
+            response_cache.bump(self.user.id)
+            with CaptureQueriesContext(connection) as queries:
+                run(size)
+            counts.append(len(queries))
+            sql = '\n'.join(query['sql'] for query in queries)
+            self.assertLessEqual(len(queries), budget, f'{len(queries)} queries for size {size}:\n{sql}')
+        self.assertEqual(len(set(counts)), 1, f'Query count grows with the data: {counts}')
+
+    def fill(self, size, subscription=None):
+        subscription = subscription or self.subscription
+        for i in range(subscription.cities.count(), size):
+            CityInSubscription.objects.create(subscription=subscription, name=f'City {City.objects.count()}')
+
+    def add_subscriptions(self, size):
+        for i in range(Subscription.objects.count(), size + 1):
+            user = User.objects.create(email=f'user_{i}@test.com', password='test_password')
+            self.fill(2, Subscription.objects.create(user=user, period_notifications=3))
+
+    def test_get_subscription(self):
+        self.assertQueryBudget(2, lambda size: self.client.get(reverse('subscription')), self.fill)
+
+    def test_create_subscription(self):
+        def setup(size):
+            Subscription.objects.filter(user=self.user).delete()
+
+        self.assertQueryBudget(
+            2, lambda size: self.client.post(reverse('subscription'), data={'period_notifications': 6}), setup,
+        )
+
+    def test_change_subscription(self):
+        self.assertQueryBudget(
+            3, lambda size: self.client.put(reverse('subscription'), data={'period_notifications': 6}), self.fill,
+        )
+
+    def test_delete_subscription(self):
+        def setup(size):
+            self.subscription = Subscription.objects.get_or_create(user=self.user, period_notifications=3)[0]
+            self.fill(size)
+
+        self.assertQueryBudget(8, lambda size: self.client.delete(reverse('subscription')), setup)
+
+    def test_list_cities(self):
+        self.assertQueryBudget(1, lambda size: self.client.get(reverse('cities')), self.fill)
+
+    @patch('weather_app.views.find_city_id', return_value=2643743)
+    def test_create_city(self, mock_find_city_id):
+        def run(size):
+            mock_find_city_id.return_value = size
+            self.client.post(reverse('cities'), data={'name': f'New city {size}'})
+
+        City.objects.create(name='New city 1', normalized_name='new city 1')
+        City.objects.create(name='New city 25', normalized_name='new city 25')
+        self.assertQueryBudget(5, run, self.fill)
+
+    def test_replace_cities(self):
+        def run(size):
+            cities = [f'Bulk city {size}-{i}' for i in range(size)]
+            city_ids = {city: 1000 * size + i for i, city in enumerate(cities)}
+            with patch('weather_app.views.find_city_ids', return_value=city_ids):
+                self.client.put(reverse('cities_bulk'), data={'cities': cities}, format='json')
+
+        self.assertQueryBudget(11, run, self.fill)
+
+    def test_one_city(self):
+        def setup(size):
+            self.fill(size + 1)
+            self.url = reverse('one_city', kwargs={'pk': self.subscription.cities.first().pk})
+
+        def run(size):
+            self.client.get(self.url)
+            self.client.delete(self.url)
+
+        self.assertQueryBudget(3, run, setup)
+
+    @patch('weather_app.views.get_weather_concurrently', return_value=[])
+    def test_get_weather(self, mock_get_weather):
+        self.assertQueryBudget(1, lambda size: self.client.get(reverse('get_weather')), self.fill)
+
+    @patch('weather_app.tasks.send_batch', return_value=[])
+    @patch('weather_app.tasks.get_weather_many')
+    def test_send_notifications(self, mock_get_weather_many, mock_send_batch):
+        mock_get_weather_many.side_effect = lambda cities: {
+            city.normalized_name: {'city': city.name, 'temperature': '1°C'} for city in cities
+        }
+
+        def setup(size):
+            # subscribers share their cities, so one SendGrid request is sent and settled whatever their number
+            for i in range(Subscription.objects.count(), size + 1):
+                user = User.objects.create(email=f'user_{i}@test.com', password='test_password')
+                subscription = Subscription.objects.create(user=user, period_notifications=3)
+                CityInSubscription.objects.create(subscription=subscription, name='London')
+                CityInSubscription.objects.create(subscription=subscription, name='Berlin')
+            self.sub_ids = list(Subscription.objects.values_list('id', flat=True))
+            OutboxMessage.objects.all().delete()
+
+        self.assertQueryBudget(
+            12, lambda size: send_notifications(Subscription.objects.filter(id__in=self.sub_ids)), setup,
+        )
+        sent = OutboxMessage.objects.filter(status=OutboxMessage.Status.SENT)
+        self.assertEqual(sent.count(), Subscription.objects.exclude(id=self.subscription.id).count())
+        self.assertEqual(mock_send_batch.call_count, len(self.sizes))
+
+    @patch('weather_app.tasks.send_batch', return_value=[])
+    def test_drain_outbox(self, mock_send_batch):
+        def setup(size):
+            OutboxMessage.objects.bulk_create([
+                OutboxMessage(subscription=self.subscription, idempotency_key=f'{size}:{i}', email='a@test.com')
+                for i in range(size)
+            ])
+
+        self.assertQueryBudget(8, lambda size: drain_outbox_task(), setup)
+
+    def test_claim_due_subscriptions(self):
+        def setup(size):
+            self.add_subscriptions(size)
+            Subscription.objects.update(next_due_at=timezone.now() - timedelta(minutes=1))
+
+        self.assertQueryBudget(4, lambda size: claim_due_subscriptions(timezone.now(), 1000), setup)
@@ -1,7 +1,11 @@
 from django.urls import path
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
-from weather_app.views import MainView, RegisterView, MySubscriptionView, MyCitiesListView, OneCityView, GetWeatherView
+from weather_app.async_views import AsyncGetWeatherView, AsyncMyCitiesCreateView
+from weather_app.views import (
+    MainView, RegisterView, MySubscriptionView, MyCitiesListView, MyCitiesBulkView, OneCityView, GetWeatherView,
+    CitySearchView, WeatherCacheStatsView, UpstreamQuotaStatsView,
+)
 
 urlpatterns = [
     path('', MainView.as_view(), name='main'),
@@ -10,6 +14,12 @@ urlpatterns = [
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/subscription/', MySubscriptionView.as_view(), name='subscription'),
     path('api/subscription/cities/', MyCitiesListView.as_view(), name='cities'),
+    path('api/subscription/cities/bulk/', MyCitiesBulkView.as_view(), name='cities_bulk'),
     path('api/subscription/cities/<pk>/', OneCityView.as_view(), name='one_city'),
+    path('api/cities/search/', CitySearchView.as_view(), name='city_search'),
     path('api/get_weather/', GetWeatherView.as_view(), name='get_weather'),
+    path('api/async/subscription/cities/', AsyncMyCitiesCreateView.as_view(), name='async_cities'),
+    path('api/async/get_weather/', AsyncGetWeatherView.as_view(), name='async_get_weather'),
+    path('api/stats/weather_cache/', WeatherCacheStatsView.as_view(), name='weather_cache_stats'),
+    path('api/stats/upstream_quota/', UpstreamQuotaStatsView.as_view(), name='upstream_quota_stats'),
 ]
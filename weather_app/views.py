@@ -1,29 +1,78 @@
-import requests
+from functools import wraps
 
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.shortcuts import render
 from django.contrib.auth import login, authenticate
-from django.http import HttpResponseRedirect
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponseRedirect, StreamingHttpResponse
 from django.urls import reverse, reverse_lazy
 from django.views import View
 from django.views.generic import CreateView
 from decouple import config
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
 from rest_framework import status
 from rest_framework.generics import ListCreateAPIView, RetrieveDestroyAPIView
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
-from WeatherReminder.settings import OPEN_WEATHER_API_URL
+from weather_app.cache import normalize_city, response_cache, weather_cache
+from weather_app.catalog import city_catalog, find_city_id, find_city_ids
 from weather_app.forms import RegisterForm
-from weather_app.models import Subscription, CityInSubscription, create_task, delete_task, edit_task
-from weather_app.tasks import get_weather
-from weather_app.serializers import SubscriptionSerializer, CityInSubscriptionSerializer
-
-
-def check_existing_city(city_name):
-    url = OPEN_WEATHER_API_URL + f'?q={city_name}&appid={config("weather_api_key")}'
-    r = requests.get(url)
-    return r.status_code != 200
+from weather_app.models import (
+    Subscription,
+    CityInSubscription,
+    add_city,
+    create_task,
+    delete_task,
+    edit_task,
+    get_subscription_for_city,
+    subscription_filter,
+    update_cities,
+)
+from weather_app.pagination import CityCursorPagination
+from weather_app.permissions import HasAPIKey
+from weather_app.ratelimit import upstream_limiter
+from weather_app.renderers import EventStreamRenderer, NDJSONRenderer
+from weather_app.tasks import get_weather_concurrently, iter_weather
+from weather_app.serializers import (
+    SubscriptionSerializer, CityInSubscriptionSerializer, CityDiffSerializer, CitySetSerializer,
+)
+
+
+def cached_read(get):
+    """
+    Serves a GET handler from the per-user response cache, with ETag and
+    Last-Modified headers and a 304 when the client's ETag is current.
+    """
+    @wraps(get)
+    def view(self, request, *args, **kwargs):
+        version = response_cache.version(request.user.id)
+        etag, last_modified = quote_etag(version['tag']), version['modified']
+        # Last-Modified has whole seconds, two versions within one second would share it
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = cached_response(get, self, request, version, *args, **kwargs)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('Authorization',))
+        return response
+    return view
+
+
+def cached_response(get, view, request, version, *args, **kwargs):
+    path = request.get_full_path()
+    data = response_cache.get(request.user.id, version, path)
+    if data is not None:
+        return Response(data)
+    response = get(view, request, *args, **kwargs)
+    if response.status_code == status.HTTP_200_OK:
+        response_cache.set(request.user.id, version, path, response.data)
+    return response
 
 
 class MainView(LoginRequiredMixin, View):
@@ -57,71 +106,143 @@ class RegisterView(CreateView):
 
 class MySubscriptionView(APIView):
 
+    @cached_read
     def get(self, request):
-        subscription = Subscription.objects.filter(user=request.user).first()
-        serializer = SubscriptionSerializer(subscription)
+        subscription = Subscription.objects.filter(user=request.user).select_related('user').prefetch_related('cities')
+        serializer = SubscriptionSerializer(subscription.first())
         return Response(serializer.data)
 
     def post(self, request):
-        new_subscription = Subscription.objects.create(
+        new_subscription = Subscription(
             user=request.user,
             period_notifications=request.data["period_notifications"]
         )
+        create_task(new_subscription, commit=False)
         new_subscription.save()
-        create_task(new_subscription)
         serializer = SubscriptionSerializer(new_subscription)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def put(self, request):
-        subscription = Subscription.objects.get(user=request.user.id)
+        subscription = Subscription.objects.select_related('user').prefetch_related('cities').get(user=request.user.id)
         subscription.period_notifications = request.data["period_notifications"]
-        subscription.save()
-        edit_task(subscription)
+        edit_task(subscription, commit=False)
+        subscription.save(update_fields=['period_notifications', 'next_due_at'])
         serializer = SubscriptionSerializer(subscription)
         return Response(serializer.data)
 
     def delete(self, request):
         subscription = Subscription.objects.get(user=request.user.id)
-        delete_task(subscription)
+        delete_task(subscription, commit=False)
         subscription.delete()
         return Response("Subscription has been deleted")
 
 
 class MyCitiesListView(ListCreateAPIView):
     serializer_class = CityInSubscriptionSerializer
+    pagination_class = CityCursorPagination
 
     def get_queryset(self):
-        return CityInSubscription.objects.filter(subscription__user=self.request.user.id)
+        return CityInSubscription.objects.filter(subscription_filter(self.request.user))
+
+    @cached_read
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
 
     def create(self, request, *args, **kwargs):
         input_city = request.data['name']
-        existing_city = CityInSubscription.objects.filter(subscription__user=self.request.user.id, name=input_city)
-        if existing_city:
+        subscription = get_subscription_for_city(request.user.id, input_city)
+        if subscription.has_city:
             return Response("City already added in your subscription")
-        if check_existing_city(input_city):
+        city_id = find_city_id(input_city)
+        if city_id is None:
             return Response("City doesn't exist")
-        subscription = Subscription.objects.get(user=request.user.id)
-        new_city = CityInSubscription.objects.create(
-            subscription=subscription,
-            name=input_city,
-        )
-        new_city.save()
+        new_city = add_city(subscription, input_city, city_id)
+        if new_city is None:
+            return Response("City already added in your subscription")
         serializer = CityInSubscriptionSerializer(new_city)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
+class MyCitiesBulkView(APIView):
+
+    def put(self, request):
+        serializer = CitySetSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.update(request, serializer.validated_data['cities'], replace=True)
+
+    def patch(self, request):
+        serializer = CityDiffSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.update(request, serializer.validated_data['add'], serializer.validated_data['remove'])
+
+    def update(self, request, add, remove=(), replace=False):
+        current = set(CityInSubscription.objects.filter(
+            subscription_filter(request.user),
+        ).values_list('city__normalized_name', flat=True))
+        city_ids = find_city_ids([city_name for city_name in add if normalize_city(city_name) not in current])
+        unknown = [city_name for city_name, city_id in city_ids.items() if city_id is None]
+        if unknown:
+            return Response({'unknown_cities': unknown}, status=status.HTTP_400_BAD_REQUEST)
+        cities = update_cities(request.user.id, add, city_ids, remove, replace)
+        # added cities are bulk created, which sends no post_save to bump the cached responses
+        response_cache.bump(request.user.id)
+        return Response(CityInSubscriptionSerializer(cities, many=True).data)
+
+
 class OneCityView(RetrieveDestroyAPIView):
     serializer_class = CityInSubscriptionSerializer
 
     def get_queryset(self):
-        return CityInSubscription.objects.filter(subscription__user=self.request.user.id)
+        # the subscription is what the delete receiver bumps the cached responses by
+        return CityInSubscription.objects.filter(subscription_filter(self.request.user)).select_related('subscription')
 
 
 class GetWeatherView(APIView):
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer, EventStreamRenderer]
 
     def get(self, request):
-        cities = CityInSubscription.objects.filter(subscription__user=request.user.id)
-        response_get_weather = []
-        for city in cities:
-            response_get_weather.append(get_weather(city.name))
+        cities = CityInSubscription.objects.filter(subscription_filter(request.user)).select_related('city')
+        # under ASGI Django 3.2 iterates a streamed body on the event loop, where neither the ORM nor
+        # the blocking waits may run, so the same lines are sent in one piece there
+        if isinstance(request.accepted_renderer, NDJSONRenderer) and not isinstance(request._request, ASGIRequest):
+            return self.stream(request.accepted_renderer, cities)
+        cities = [city_in_subscription.city for city_in_subscription in cities]
+        response_get_weather = get_weather_concurrently(cities, settings.WEATHER_REQUEST_DEADLINE)
         return Response(response_get_weather)
+
+    def stream(self, renderer, cities):
+        chunk_size = settings.WEATHER_STREAM_CHUNK_SIZE
+        cities = (city_in_subscription.city for city_in_subscription in cities.iterator(chunk_size=chunk_size))
+        results = iter_weather(cities, settings.WEATHER_REQUEST_DEADLINE, chunk_size)
+        response = StreamingHttpResponse(
+            (renderer.render_item(result) for result in results),
+            content_type=f'{renderer.media_type}; charset={renderer.charset}',
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class CitySearchView(APIView):
+
+    def get(self, request):
+        try:
+            limit = min(int(request.query_params.get('limit', 10)), 50)
+        except ValueError:
+            limit = 10
+        cities = city_catalog.search(request.query_params.get('q', ''), max(limit, 0))
+        return Response([city._asdict() for city in cities])
+
+
+class WeatherCacheStatsView(APIView):
+    permission_classes = (IsAdminUser, HasAPIKey)
+
+    def get(self, request):
+        return Response(weather_cache.stats())
+
+
+class UpstreamQuotaStatsView(APIView):
+    permission_classes = (IsAdminUser, HasAPIKey)
+
+    def get(self, request):
+        return Response(upstream_limiter.usage())